@@ -59,8 +59,7 @@ class FileLoader:
             pdf_writer.add_page(page)
         pdf_buffer = BytesIO()
         pdf_writer.write(pdf_buffer)
-        pdf_buffer.seek(0)
-        self.buffer = pdf_buffer.read()
+        self.buffer = pdf_buffer.getvalue()
         self._check_if_pdf_is_encrypted()
 
     @none_on_exception
@@ -128,10 +127,8 @@ class FileLoader:
 
     @none_on_exception
     def get_bytestream(self):
-        file_buffer = BytesIO()
-        file_buffer.write(self.buffer)
-        file_buffer.seek(0)
-        return file_buffer
+        # BytesIO teilt sich den Speicher mit den Ausgangsbytes, solange nicht geschrieben wird
+        return BytesIO(self.buffer)
     
     @none_on_exception
     def load_buffer(self, file_input):
@@ -213,6 +210,8 @@ class ImageClassifier:
     def __init__(self, url = None, api_key = None, **kwargs):
         self.url = url
         self.api_key = api_key
+        # Verbindungen zum Klassifizierungsdienst über mehrere Uploads hinweg wiederverwenden
+        self.session = requests.Session()
 
     def classify_image(self, file_buffer):
         try:
@@ -220,7 +219,7 @@ class ImageClassifier:
             files = {'image': file_buffer}
 
             # Sende die POST-Anfrage an den Endpoint mit dem Bild als Datei
-            response = requests.post(self.url + '/rate', headers=headers, files=files)
+            response = self.session.post(self.url + '/rate', headers=headers, files=files)
 
             if response.status_code == 200:
                 return response.json()
@@ -4,17 +4,21 @@
 Depose Files: A simple file deposition API using Flask.
 """
 
-from flask import Flask, jsonify, send_file, render_template, request, url_for, redirect, send_from_directory
+from flask import Flask, jsonify, send_file, render_template, request, url_for, redirect, send_from_directory, Response, stream_with_context
 from flask_restful import Api, Resource
 import os
 from docdepotdb import *
 import ddclient
 from datetime import datetime
 import json
+import shutil
+import tempfile
+import logging
 from functools import wraps
-import hashlib
 from helper import *
 
+logger = logging.getLogger(__name__)
+
 # Define directories and create them if they don't exist
 datadir = 'data'
 documentdir = f'{datadir}/documents'
@@ -22,13 +26,13 @@ attachmentdir = f'{datadir}/attachments'
 _ = [os.makedirs(path) for path in [datadir, documentdir, attachmentdir] if not os.path.exists(path)]
 
 # ENV VARS
-env_vars = EnvironmentConfigProvider()
+env_vars = get_env_config()
 # Set default API key (you can also use environment variables)
 apikey = env_vars.apikey
 # default redirect target
 default_redirect = env_vars.default_redirect
 # WEBSITE SETTINGS
-html_settings = env_vars._get_html_configs()
+html_settings = dict(env_vars._get_html_configs())
 
 # init gotify, if set
 gotify = env_vars._get_gotify()
@@ -51,7 +55,11 @@ else:
 # Initialize the DatabaseManager and cleanup expired files
 db = DatabaseManager(data=f'{datadir}/data.db', docdir = documentdir)
 if env_vars.cleanup_db_on_start:
-    db.delete_expired_items()
+    # A failed cleanup (e.g. a locked database) must not keep the worker from starting
+    try:
+        db.delete_expired_items()
+    except Exception:
+        logger.exception("Cleanup of expired items on startup failed")
     db.delete_orphans()
     db._calculate_missing_checksums()
     db._delete_duplicates_from_attachments()
@@ -222,58 +230,63 @@ class AttachmentResource(Resource):
                         return performed_checks.get_checks(), 400
 
             # FILE COMPRESSION
-            imaginary = env_vars._get_imaginary(loaded_file)
-            if imaginary:
-                if loaded_file.attributes.get('is_image', False):
-                    compressed_buffer = imaginary.autorotate_and_resize()
-                    if not compressed_buffer:
-                        performed_checks.add_check("Bild-Kompression", passed=False, description="Fehler beim Komprimieren des Bildes. Bitte ein PDF hochladen.")
-                        return performed_checks.get_checks(), 400
+            # A compressed PDF is written into a spool that moves to disk once it exceeds 8 MiB
+            with tempfile.SpooledTemporaryFile(max_size=8 << 20) as spool:
+                imaginary = env_vars._get_imaginary(loaded_file)
+                compressed_file = None
+                if imaginary:
+                    if loaded_file.attributes.get('is_image', False):
+                        compressed_buffer = imaginary.autorotate_and_resize()
+                        if not compressed_buffer:
+                            performed_checks.add_check("Bild-Kompression", passed=False, description="Fehler beim Komprimieren des Bildes. Bitte ein PDF hochladen.")
+                            return performed_checks.get_checks(), 400
                     
-                    loaded_file.buffer = compressed_buffer
-                    loaded_file.attributes.update({'filename' : imaginary.fullfilename})
+                        loaded_file.buffer = compressed_buffer
+                        loaded_file.attributes.update({'filename' : imaginary.fullfilename})
                     
-                elif loaded_file.attributes.get('is_pdf', False):
-                    compressed_buffer = imaginary.compress_pdf()
-                    if not compressed_buffer:
-                        performed_checks.add_check("PDF-Kompression", passed=False, description="Fehler beim Komprimieren des PDFs.")
-                        return performed_checks.get_checks(), 400
-
-                    loaded_file.buffer = compressed_buffer            
+                    elif loaded_file.attributes.get('is_pdf', False):
+                        compressed_file = imaginary.compress_pdf(output=spool)
+                        if not compressed_file:
+                            performed_checks.add_check("PDF-Kompression", passed=False, description="Fehler beim Komprimieren des PDFs.")
+                            return performed_checks.get_checks(), 400
             
-            ## ADDING TO DB
+                ## ADDING TO DB
 
             
-            dbdata = {
-                'token': data.get('token'),
-                'name': loaded_file.attributes.get('filename'),
-                'checksum': loaded_file.attributes.get('sha256_hash'),
-            }
-
-            # Add attachment to the database
-            aid = db.add_attachment(**dbdata)
+                dbdata = {
+                    'token': data.get('token'),
+                    'name': loaded_file.attributes.get('filename'),
+                    'checksum': loaded_file.attributes.get('sha256_hash'),
+                }
 
-            if aid:
-                # Save the attachment file to the ./attachments/ directory
-                attachment_path = f'./{attachmentdir}/{aid}'
-                with open(attachment_path, 'wb') as new_file:
-                    new_file.write(loaded_file.buffer)
+                # Add attachment to the database
+                aid = db.add_attachment(**dbdata)
+
+                if aid:
+                    # Save the attachment file to the ./attachments/ directory
+                    attachment_path = f'./{attachmentdir}/{aid}'
+                    with open(attachment_path, 'wb') as new_file:
+                        if compressed_file:
+                            compressed_file.seek(0)
+                            shutil.copyfileobj(compressed_file, new_file)
+                        else:
+                            new_file.write(loaded_file.buffer)
     
-                response = {
-                    "aid": aid,
-                    "status": "success"
-                }
-                if gotify:
-                    hash_sid = ShortHash(document["user_uid"]).get()
-                    gotify.send(f'{document["title"]}\n{hash_sid}\n{request.scheme}://{request.host}/{dbdata["token"]}')
+                    response = {
+                        "aid": aid,
+                        "status": "success"
+                    }
+                    if gotify:
+                        hash_sid = ShortHash(document["user_uid"]).get()
+                        gotify.send(f'{document["title"]}\n{hash_sid}\n{request.scheme}://{request.host}/{dbdata["token"]}')
                     
-                return performed_checks.get_checks(), 201
-            else:
-                response = {
-                    "error": "Token not found",
-                    "status": "error"
-                }
-                return response, 500
+                    return performed_checks.get_checks(), 201
+                else:
+                    response = {
+                        "error": "Token not found",
+                        "status": "error"
+                    }
+                    return response, 500
             
         except Exception as e:
             if gotify_error:
@@ -329,10 +342,8 @@ class DocumentResource(Resource):
             file_path = f'./{documentdir}/{did}'
             file.save(file_path)
             
-            # Verify the checksum of the saved file
-            with open(file_path, 'rb') as saved_file:
-                saved_file_content = saved_file.read()
-                saved_checksum = hashlib.sha256(saved_file_content).hexdigest()
+            # Verify the checksum of the saved file without reading it into memory at once
+            saved_checksum = ChecksumCalculator().calc_from_file(file_path)
 
             if data.get('checksum', None) != saved_checksum:
                 # Delete the document and return an error if the checksums do not match
@@ -623,9 +634,7 @@ def convert_datetimes_to_strings(data_func):
 
             # Convert datetime objects to strings before returning
             for entry in data:
-                for key, value in entry.items():
-                    if isinstance(value, datetime):
-                        entry[key] = value.strftime('%Y-%m-%d %H:%M:%S.%f') if value else None
+                _datetimes_to_strings(entry)
 
             return data if data else {"message": f"No {data_func.__name__} found."}, 200
         except Exception as e:
@@ -633,6 +642,56 @@ def convert_datetimes_to_strings(data_func):
 
     return wrapper
 
+def _datetimes_to_strings(entry):
+    """
+    Convert the datetime values of a dictionary to string representations in place.
+
+    Parameters:
+    - entry: Dictionary with the values to convert.
+
+    Returns:
+    - The converted dictionary.
+    """
+    for key, value in entry.items():
+        if isinstance(value, datetime):
+            entry[key] = value.strftime('%Y-%m-%d %H:%M:%S.%f') if value else None
+    return entry
+
+def stream_datetimes_as_strings(iter_func):
+    """
+    Decorator function to stream the dictionaries of a generator as a JSON list with datetime objects converted to strings.
+
+    Parameters:
+    - iter_func: Function that returns an iterable of dictionaries.
+
+    Returns:
+    - Wrapper function that streams the JSON response row by row.
+    """
+    @wraps(iter_func)
+    def wrapper(*args, **kwargs):
+        try:
+            auth_key = request.headers.get('Authorization')
+            if auth_key != apikey:
+                return jsonify({"error": "Unauthorized"}), 401
+
+            # Fetch the first row up front so that database errors and empty results are reported as before
+            rows = iter(iter_func(*args, **kwargs))
+            first = next(rows, None)
+            if first is None:
+                return {"message": f"No {iter_func.__name__} found."}, 200
+
+            def generate():
+                yield '[' + json.dumps(_datetimes_to_strings(first))
+                for row in rows:
+                    yield ',' + json.dumps(_datetimes_to_strings(row))
+                yield ']'
+
+            return Response(stream_with_context(generate()), mimetype='application/json')
+        except Exception as e:
+            return {"error": str(e)}, 500
+
+    return wrapper
+
 class GetAttachmentListResource(Resource):
     @convert_datetimes_to_strings
     def get(self):
@@ -645,26 +704,26 @@ class GetAttachmentListResource(Resource):
         return db.get_all_attachments()
 
 class GetEventsResource(Resource):
-    @convert_datetimes_to_strings
+    @stream_datetimes_as_strings
     def get(self):
         """
         Endpoint for retrieving all events.
 
         Returns:
-        - A list of dictionaries containing event information.
+        - A streamed list of dictionaries containing event information.
         """
-        return db.get_events()
+        return db.iter_events()
 
 class GetDocumentsResource(Resource):
-    @convert_datetimes_to_strings
+    @stream_datetimes_as_strings
     def get(self):
         """
         Endpoint for retrieving all documents.
 
         Returns:
-        - A list of dictionaries containing document information.
+        - A streamed list of dictionaries containing document information.
         """
-        return db.get_documents()
+        return db.iter_documents()
 
 class GetUsersResource(Resource):
     @convert_datetimes_to_strings
@@ -4,24 +4,48 @@
 A simple database management system for storing users, documents, tokens, and events.
 """
 from contextlib import contextmanager
-from sqlalchemy import create_engine, Column, String, Boolean, Integer, DateTime, ForeignKey, func, and_, MetaData, inspect, text, desc
+from sqlalchemy import create_engine, Column, String, Boolean, Integer, DateTime, ForeignKey, Index, func, and_, or_, MetaData, inspect, text, desc, update, delete, select, insert, literal, bindparam, case
 from sqlalchemy.sql import func
-from sqlalchemy.orm import relationship, sessionmaker, Session, aliased, declarative_base, joinedload
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy.event import listen
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import relationship, sessionmaker, aliased, declarative_base, joinedload
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
 import uuid
-import pytz
+from zoneinfo import ZoneInfo
 from datetime import datetime, timedelta, timezone
 import os
+import time
+import hashlib
+import logging
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 from helper import *
 
-env_vars = EnvironmentConfigProvider()
+logger = logging.getLogger(__name__)
+
+env_vars = get_env_config()
 
 ## timezone settings
 def get_german_timezone():
-    berlin = pytz.timezone('Europe/Berlin')
-    return berlin.localize(datetime.now()).astimezone(berlin).tzinfo
+    return ZoneInfo('Europe/Berlin')
 
 local_timezone = get_german_timezone()
+_ONE_YEAR = timedelta(days=365)
+
+def _now():
+    return datetime.now(local_timezone)
+
+def _in_one_year():
+    return datetime.now(local_timezone) + _ONE_YEAR
+
+@lru_cache(maxsize=1)
+def _local_now_naive_at(second):
+    return datetime.now(local_timezone).replace(tzinfo=None)
+
+def _local_now_naive():
+    # The naive local time is only computed once per second for the validity checks
+    return _local_now_naive_at(int(time.time()))
 ##
 
 Base = declarative_base()
@@ -35,7 +59,7 @@ class Redirect(Base):
     uid = Column(String, unique=True, nullable=True)
     did = Column(String, unique=True, nullable=True)
     url = Column(String)
-    valid_until = Column(DateTime, default=lambda: datetime.now(local_timezone) + timedelta(days=365))
+    valid_until = Column(DateTime, default=_in_one_year)
     description = Column(String)
 
 class User(Base):
@@ -44,7 +68,7 @@ class User(Base):
     """
     __tablename__ = 'users'
     uid = Column(String, primary_key=True)
-    valid_until = Column(DateTime, default=lambda: datetime.now(local_timezone) + timedelta(days=365))
+    valid_until = Column(DateTime, default=_in_one_year)
     documents = relationship('Document', back_populates='user', cascade='all, delete-orphan')
 
 class Document(Base):
@@ -53,15 +77,21 @@ class Document(Base):
     """
     __tablename__ = 'documents'
     did = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()), unique=True)
-    valid_until = Column(DateTime, default=lambda: datetime.now(local_timezone) + timedelta(days=365))
+    valid_until = Column(DateTime, default=_in_one_year)
     title = Column(String)
     filename = Column(String)
     checksum = Column(String)
-    upload_datetime = Column(DateTime, default=lambda: datetime.now(local_timezone))
+    upload_datetime = Column(DateTime, default=_now)
     allow_attachment = Column(Boolean, default=True)
+    first_event_datetime = Column(DateTime, index=True, nullable=True)
     user_uid = Column(String, ForeignKey('users.uid'))
     user = relationship('User', back_populates='documents')
     tokens = relationship('Token', back_populates='document', cascade='all, delete-orphan')
+    __table_args__ = (
+        Index('ix_documents_user_uid', 'user_uid'),
+        Index('ix_documents_checksum', 'checksum'),
+        Index('ix_documents_upload_datetime', 'upload_datetime'),
+    )
 
 class Token(Base):
     """
@@ -71,11 +101,15 @@ class Token(Base):
     tid = Column(Integer, primary_key=True, autoincrement=True)
     did = Column(String, ForeignKey('documents.did'))
     token = Column(String, unique=True, default=lambda: str(uuid.uuid4()))
-    valid_until = Column(DateTime, default=lambda: datetime.now(local_timezone) + timedelta(days=365))
-    allow_until = Column(DateTime, default=lambda: datetime.now(local_timezone) + timedelta(days=env_vars.get_default_attachment_days()))
-    create = Column(DateTime, default=lambda: datetime.now(local_timezone))
+    valid_until = Column(DateTime, default=_in_one_year)
+    allow_until = Column(DateTime, default=lambda: _now() + timedelta(days=env_vars.get_default_attachment_days()))
+    create = Column(DateTime, default=_now)
     document = relationship('Document', back_populates='tokens')
     events = relationship('Event', back_populates='token', cascade='all, delete-orphan', foreign_keys='[Event.tid]')
+    __table_args__ = (
+        Index('ix_tokens_did', 'did'),
+        Index('ix_tokens_valid_until', 'valid_until'),
+    )
 
 class Event(Base):
     """
@@ -83,10 +117,14 @@ class Event(Base):
     """
     __tablename__ = 'events'
     eid = Column(Integer, primary_key=True, autoincrement=True)
-    date = Column(DateTime, default=lambda: datetime.now(local_timezone))
+    date = Column(DateTime, default=_now)
     tid = Column(Integer, ForeignKey('tokens.tid'))
     event = Column(String)
     token = relationship('Token', back_populates='events', foreign_keys=[tid])
+    __table_args__ = (
+        Index('ix_events_tid_date', 'tid', 'date'),
+        Index('ix_events_tid_event', 'tid', 'event'),
+    )
     
 class Attachment(Base):
     """
@@ -97,7 +135,11 @@ class Attachment(Base):
     did = Column(Integer, ForeignKey('documents.did'))
     name = Column(String)
     checksum = Column(String)
-    uploaded = Column(DateTime, default=lambda: datetime.now(local_timezone))
+    uploaded = Column(DateTime, default=_now)
+    __table_args__ = (
+        Index('ix_attachments_did', 'did'),
+        Index('ix_attachments_checksum', 'checksum'),
+    )
     
 class Summarys(Base):
     """
@@ -106,7 +148,7 @@ class Summarys(Base):
     __tablename__ = 'summarys'
     sumtoken = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
     sid = Column(String, ForeignKey('users.uid'))
-    create = Column(DateTime, default=lambda: datetime.now(local_timezone))
+    create = Column(DateTime, default=_now)
     
 class SummaryEvents(Base):
     """
@@ -115,9 +157,87 @@ class SummaryEvents(Base):
     __tablename__ = 'summary_events'
     seid = Column(Integer, primary_key=True, autoincrement=True)
     sumtoken = Column(String, ForeignKey('summarys.sumtoken'))
-    date = Column(DateTime, default=lambda: datetime.now(local_timezone))
+    date = Column(DateTime, default=_now)
     event = Column(String)
 
+# Token lookup by value, compiled once and reused for every request
+_TOKEN_STMT = select(Token).where(Token.token == bindparam('token'))
+_TOKEN_WITH_DOCUMENT_STMT = _TOKEN_STMT.options(joinedload(Token.document).joinedload(Document.user))
+
+# Column projections for the export endpoints, compiled once as well
+_EVENTS_STMT = (
+    select(
+        Event.date,
+        Event.event,
+        Token.token,
+        User.uid.label('user_uid'),
+        Document.did,
+        Document.title,
+    )
+    .select_from(Event)
+    .join(Token, Event.tid == Token.tid)
+    .join(Document, Token.did == Document.did)
+    .join(User, Document.user_uid == User.uid)
+)
+_DOCUMENTS_STMT = (
+    select(
+        Document.did,
+        Document.title,
+        Document.filename,
+        User.uid.label('user_uid'),
+        Document.upload_datetime,
+    )
+    .select_from(Document)
+    .join(User, Document.user_uid == User.uid)
+)
+_USERS_STMT = select(User.uid, User.valid_until)
+
+# Time between the upload of a document and its first event in seconds
+first_event_delay_seconds = (func.julianday(Document.first_event_datetime) - func.julianday(Document.upload_datetime)) * 86400
+
+def seconds_to_timedelta(seconds):
+    """
+    Convert a number of seconds returned by the database into a timedelta.
+
+    :param seconds: The number of seconds or None.
+    :return: A timedelta object, or None if no seconds are given.
+    """
+    return timedelta(seconds=seconds) if seconds is not None else None
+
+# Units for cluster_time_span from largest to smallest: (seconds, singular, plural)
+_TIME_SPAN_UNITS = (
+    (86400, 'Tag', 'Tage'),
+    (3600, 'Stunde', 'Stunden'),
+    (60, 'Minute', 'Minuten'),
+)
+
+def _chunks(seq, n=500):
+    """
+    Split a list of IDs into slices that stay below SQLite's bound parameter limit of 999.
+
+    :param seq: The list to split.
+    :param n: The maximum length of a slice.
+    :return: A generator of list slices.
+    """
+    for i in range(0, len(seq), n):
+        yield seq[i:i + n]
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """
+    Configure every new SQLite connection for concurrent access.
+
+    WAL lets readers proceed while a writer commits, and synchronous=NORMAL avoids an fsync on every commit in WAL mode.
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA cache_size=-65536")
+    cursor.execute("PRAGMA mmap_size=268435456")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
+
+_CACHE_MISS = object()
+
 class DatabaseManager:
     """
     Class for managing the database operations.
@@ -129,17 +249,27 @@ class DatabaseManager:
         :param data: The name of the database file.
         """
         db_url = f'sqlite:///{data}'
-        self.engine = create_engine(db_url, echo=False)
-        self.session = Session(bind=self.engine)
+        self.engine = create_engine(
+            db_url,
+            echo=False,
+            poolclass=QueuePool,
+            pool_size=5,
+            max_overflow=10,
+            pool_pre_ping=True,
+            pool_recycle=3600,
+            connect_args={'check_same_thread': False, 'timeout': 30},
+        )
+        listen(self.engine, 'connect', set_sqlite_pragmas)
+        self._Session = sessionmaker(bind=self.engine, expire_on_commit=False)
+        self._document_cache = TTLCache(maxsize=4096, ttl=60)
         self.create_tables()
         self.docdir = docdir
         self.attachmentdir = attachmentdir
-        self.env_vars = EnvironmentConfigProvider()
+        self.env_vars = get_env_config()
 
     @contextmanager
     def get_session(self):
-        Session = sessionmaker(bind=self.engine)
-        session = Session()
+        session = self._Session()
         try:
             yield session
         except Exception as e:
@@ -150,15 +280,15 @@ class DatabaseManager:
 
     def __del__(self):
         """
-        Destructor to close the database session when the object is destroyed.
+        Destructor to release the database connections when the object is destroyed.
         """
         self.close_session()
         
     def close_session(self):
         """
-        Close the current database session.
+        Close all pooled database connections.
         """
-        self.session.close()
+        self.engine.dispose()
 
     def create_tables(self):
         """
@@ -167,54 +297,84 @@ class DatabaseManager:
         Base.metadata.create_all(bind=self.engine)
         self.ensure_all_tables()
         
+    def _schema_version(self):
+        """
+        Compute a fingerprint of the tables, columns and indexes defined by the models.
+
+        :return: A positive 31-bit integer suitable for PRAGMA user_version.
+        """
+        signature = sorted(
+            [(table_name, 'column', column.name, str(column.type)) for table_name, table in Base.metadata.tables.items() for column in table.columns]
+            + [(table_name, 'index', index.name, str([column.name for column in index.columns])) for table_name, table in Base.metadata.tables.items() for index in table.indexes]
+        )
+        return int(hashlib.sha256(repr(signature).encode()).hexdigest()[:8], 16) & 0x7fffffff
+
     def ensure_all_tables(self):
+        # Skip the reflection if the database was already migrated to the current models
+        schema_version = self._schema_version()
+        with self.engine.connect() as con:
+            if con.exec_driver_sql("PRAGMA user_version").scalar() == schema_version:
+                return
+
         # Create a MetaData object
         metadata = MetaData()
-    
-        # Bind the MetaData object with the existing database engine
-        metadata.reflect(bind=self.engine)
-    
-        # Iterate over all tables in the Base.metadata
-        for table_name, table in Base.metadata.tables.items():
-            # Get the existing table from the reflected metadata
-            existing_table = metadata.tables.get(table_name)
-    
-            # Check if the table does not exist in the database
-            if existing_table is None:
-                # If the table does not exist, create it
-                table.create(bind=self.engine)
-    
-                # Print a message indicating that the table has been created
-                print(f"Table '{table_name}' created.")
-            else:
-                # If the table already exists, check for missing columns
-                for column in table.columns:
-                    # Check if the column does not exist in the existing table
-                    if column.name not in existing_table.columns:
-                        # If the column does not exist, add it to the existing table
-                        new_column = Column(
-                            column.name,
-                            column.type,
-                            primary_key=column.primary_key,
-                            nullable=column.nullable,
-                            default=column.default,
-                            unique=column.unique
-                        )
-                        with self.engine.connect() as con:
-                            column_info = f"{new_column.name} {new_column.type.compile(self.engine.dialect)}"
-                            add_query = f"ALTER TABLE {table_name} ADD COLUMN {column_info}"
-                            # print(add_query)
-                            con.execute(text(add_query))
-    
-                        # Print a message indicating that the column has been created
-                        print(f"Column '{column.name}' added to table '{table_name}'.")
 
-                        # Check if the table name is 'events' and column name is 'event'
-                        if table_name == 'events' and 'event' in [col.name for col in table.columns]:
-                            events_with_nan = self.session.query(Event).filter(Event.event == None).all()
-                            for event in events_with_nan:
-                                event.event = 'download'
-                            self.session.commit()
+        # Run the whole migration on a single connection
+        with self.engine.begin() as con:
+            # Reflect the existing database schema
+            metadata.reflect(bind=con)
+            events_migrated = False
+            first_event_migrated = False
+
+            # Iterate over all tables in the Base.metadata
+            for table_name, table in Base.metadata.tables.items():
+                # Get the existing table from the reflected metadata
+                existing_table = metadata.tables.get(table_name)
+
+                # Check if the table does not exist in the database
+                if existing_table is None:
+                    # If the table does not exist, create it
+                    table.create(bind=con)
+
+                    # Print a message indicating that the table has been created
+                    print(f"Table '{table_name}' created.")
+                else:
+                    # If the table already exists, check for missing columns
+                    for column in table.columns:
+                        # Check if the column does not exist in the existing table
+                        if column.name not in existing_table.columns:
+                            # If the column does not exist, add it to the existing table
+                            column_info = f"{column.name} {column.type.compile(self.engine.dialect)}"
+                            con.execute(text(f"ALTER TABLE {table_name} ADD COLUMN {column_info}"))
+
+                            # Print a message indicating that the column has been created
+                            print(f"Column '{column.name}' added to table '{table_name}'.")
+
+                            if table_name == 'events':
+                                events_migrated = True
+                            elif table_name == 'documents' and column.name == 'first_event_datetime':
+                                first_event_migrated = True
+
+                    # Create indexes that were added to the models after the table was created
+                    for index in table.indexes:
+                        index.create(bind=con, checkfirst=True)
+
+            # Events recorded before the event column existed are downloads
+            if events_migrated:
+                con.execute(update(Event).where(Event.event == None).values(event='download'))
+
+            # Backfill the first event of documents whose events were recorded before the column existed
+            if first_event_migrated:
+                first_event = (
+                    select(func.min(Event.date))
+                    .join(Token, Event.tid == Token.tid)
+                    .where(Token.did == Document.did)
+                    .scalar_subquery()
+                )
+                con.execute(update(Document).values(first_event_datetime=first_event))
+
+            # Remember that the database matches the current models
+            con.exec_driver_sql(f"PRAGMA user_version = {schema_version}")
 
     @none_on_exception
     def get_token_deadlines(self):
@@ -250,7 +410,7 @@ class DatabaseManager:
         """
         with self.get_session() as session:
             # Find the token in the database
-            token = session.query(Token).filter_by(token=token_value).first()
+            token = session.execute(_TOKEN_WITH_DOCUMENT_STMT, {'token': token_value}).scalar_one_or_none()
 
             if token:
                 # Get the associated document and user
@@ -356,7 +516,7 @@ class DatabaseManager:
         """
         with self.get_session() as session:
             # Find the token in the database
-            token = session.query(Token).filter_by(token=token_value).first()
+            token = session.execute(_TOKEN_STMT, {'token': token_value}).scalar_one_or_none()
 
             if token and token.allow_until is not None:
                 return token.allow_until.replace(hour=23, minute=59, second=0, microsecond=0)
@@ -371,7 +531,7 @@ class DatabaseManager:
         :return: True if current time is before allow_until, False otherwise.
         """
         try:
-            current_time = datetime.now(local_timezone).replace(tzinfo=None)
+            current_time = _local_now_naive()
     
             token_deadline = self._get_deadline_for_attachment(token_value)
     
@@ -385,7 +545,7 @@ class DatabaseManager:
     def _db_migration(self):
         self._ensure_attachment_deadlines()
         self._ensure_allow_attachment_bool()
-                            
+
     def _ensure_attachment_deadlines(self):
         """
         Sets the allow_until for tokens with None allow_until exactly one week after the create date.
@@ -412,40 +572,33 @@ class DatabaseManager:
                 document.allow_attachment = True
             
             session.commit()
+            self._document_cache.clear()
 
                             
     def check_if_checksum_exists(self, checksum):
         with self.get_session() as session:
-            existing_attachment_checksum = session.query(Attachment).filter_by(checksum=checksum).first()
-            existing_document_checksum = session.query(Document).filter_by(checksum=checksum).first()
-
-            return existing_attachment_checksum is not None or existing_document_checksum is not None
+            return session.query(
+                or_(
+                    session.query(Attachment.aid).filter(Attachment.checksum == checksum).exists(),
+                    session.query(Document.did).filter(Document.checksum == checksum).exists(),
+                )
+            ).scalar()
                             
     def _delete_duplicates_from_attachments(self):
         with self.get_session() as session:
-            subq = (
-                session.query(func.min(Attachment.uploaded).label('min_uploaded'))
-                .group_by(Attachment.checksum)
-                .having(func.count(Attachment.checksum) > 1)
-                .subquery()
+            # Keep the oldest attachment of every checksum and delete all later uploads
+            duplicate = aliased(Attachment)
+            min_uploaded = (
+                select(func.min(duplicate.uploaded))
+                .where(duplicate.checksum == Attachment.checksum)
+                .scalar_subquery()
             )
 
-            oldest_to_keep = (
-                session.query(Attachment.checksum, func.min(Attachment.uploaded).label('min_uploaded'))
-                .group_by(Attachment.checksum)
-                .having(func.count(Attachment.checksum) > 1)
+            session.execute(
+                delete(Attachment)
+                .where(Attachment.checksum != None, Attachment.uploaded > min_uploaded)
+                .execution_options(synchronize_session=False)
             )
-
-            for checksum, min_uploaded in oldest_to_keep:
-                duplicates_to_delete = (
-                    session.query(Attachment)
-                    .filter(Attachment.checksum == checksum, Attachment.uploaded != min_uploaded)
-                    .all()
-                )
-
-                for duplicate in duplicates_to_delete:
-                    session.delete(duplicate)
-
             session.commit()
             
     def _calculate_missing_checksums(self):
@@ -455,99 +608,108 @@ class DatabaseManager:
                             
     def _calculate_missing_checksum_of_attachments(self):
         with self.get_session() as session:
-            attachments = session.query(Attachment).filter(Attachment.checksum == None).all()
-
-            for attachment in attachments:
-                file_path = os.path.join(self.attachmentdir, attachment.aid)
-                checksum = ChecksumCalculator().calc_from_file(file_path)
-
-                attachment.checksum = checksum
+            aids = [aid for aid, in session.query(Attachment.aid).filter(Attachment.checksum == None).all()]
+            checksums = self._calculate_checksums(self.attachmentdir, aids)
 
-            session.commit()
+            if checksums:
+                session.execute(update(Attachment), [{'aid': aid, 'checksum': checksum} for aid, checksum in checksums])
+                session.commit()
             
     def _calculate_missing_checksum_of_documents(self):
         with self.get_session() as session:
-            documents = session.query(Document).filter(Document.checksum == None).all()
+            dids = [did for did, in session.query(Document.did).filter(Document.checksum == None).all()]
+            checksums = self._calculate_checksums(self.docdir, dids)
 
-            for document in documents:
-                file_path = os.path.join(self.docdir, document.did)
-                checksum = ChecksumCalculator().calc_from_file(file_path)
+            if checksums:
+                session.execute(update(Document), [{'did': did, 'checksum': checksum} for did, checksum in checksums])
+                session.commit()
 
-                document.checksum = checksum
+    def _calculate_checksums(self, directory, names):
+        """
+        Hash the given files of a directory in parallel.
 
-            session.commit()
+        :param directory: The directory containing the files.
+        :param names: The file names to hash.
+        :return: A list of (name, checksum) tuples.
+        """
+        checksums = ChecksumCalculator.hash_many([os.path.join(directory, name) for name in names])
+        return [(name, checksums[os.path.join(directory, name)]) for name in names]
                             
     def get_all_attachments(self):
         with self.get_session() as session:
+            # Pick one token per document so documents with several tokens do not repeat attachments
+            first_tokens = (
+                session.query(Token.did, func.min(Token.tid).label('tid'))
+                .group_by(Token.did)
+                .subquery()
+            )
+
             attachments = (
-                session.query(Attachment, Document, User, Token)
+                session.query(
+                    Attachment.aid,
+                    User.uid,
+                    Document.did,
+                    Token.token,
+                    Attachment.name,
+                    Attachment.uploaded,
+                )
                 .join(Document, Attachment.did == Document.did)
                 .join(User, Document.user_uid == User.uid)
-                .join(Token, Token.did == Document.did)
+                .join(first_tokens, first_tokens.c.did == Document.did)
+                .join(Token, Token.tid == first_tokens.c.tid)
                 .order_by(desc(Attachment.uploaded))
-                .all()
+                .yield_per(500)
             )
 
-            attachments_list = []
-            for attachment, document, user, token in attachments:
-                attachment_info = {
-                    'aid': attachment.aid,
-                    'uid': user.uid,
-                    'did': document.did,
-                    'token': token.token,
-                    'name': attachment.name,
-                    'uploaded': attachment.uploaded,
-                }
-                attachments_list.append(attachment_info)
-
-            return attachments_list
+            return [attachment._asdict() for attachment in attachments]
 
     def get_attachments_for_token(self, token):
         with self.get_session() as session:
-            token_obj = session.query(Token).filter(Token.token == token).first()
-            if token_obj:
-                did = token_obj.document.did
-                attachments = session.query(Attachment).filter(Attachment.did == did).order_by(desc(Attachment.uploaded)).all()
-                attachments_list = []
-                for attachment in attachments:
-                    attachment_info = self.get_attachment_info(attachment.aid)
-                    if attachment_info:
-                        attachments_list.append(attachment_info)
-                return attachments_list
-            else:
-                return []
+            attachments = (
+                session.query(Attachment, Document)
+                .join(Document, Attachment.did == Document.did)
+                .join(Token, Token.did == Document.did)
+                .filter(Token.token == token)
+                .order_by(desc(Attachment.uploaded))
+                .all()
+            )
+            return [self._build_attachment_info(attachment, document) for attachment, document in attachments]
 
     def get_attachment_info(self, aid):
         with self.get_session() as session:
-            attachment = session.query(Attachment).filter(Attachment.aid == aid).first()
-            if attachment:
-                document = session.query(Document).filter(Document.did == attachment.did).first()
-                if document:
-                    return {
-                        'aid': attachment.aid,
-                        'name': attachment.name,
-                        'checksum': attachment.checksum,
-                        'uploaded': attachment.uploaded,
-                        'doc_upload_time': document.upload_datetime,
-                        'delta_upload' : attachment.uploaded - document.upload_datetime,
-                        'allow_attachment' : document.allow_attachment==True,
-                        'in_grace_period': datetime.now(local_timezone).replace(tzinfo=None) <= attachment.uploaded + timedelta(minutes=self.env_vars.get_grace_minutes()),
-                        'doc_title': document.title,
-                        'did': document.did,
-                        'user_id': document.user_uid,
-                        }
-                else:
-                    return None
+            result = (
+                session.query(Attachment, Document)
+                .join(Document, Attachment.did == Document.did)
+                .filter(Attachment.aid == aid)
+                .first()
+            )
+            if result:
+                return self._build_attachment_info(*result)
             else:
                 return None
 
+    def _build_attachment_info(self, attachment, document):
+        return {
+            'aid': attachment.aid,
+            'name': attachment.name,
+            'checksum': attachment.checksum,
+            'uploaded': attachment.uploaded,
+            'doc_upload_time': document.upload_datetime,
+            'delta_upload' : attachment.uploaded - document.upload_datetime,
+            'allow_attachment' : document.allow_attachment==True,
+            'in_grace_period': _local_now_naive() <= attachment.uploaded + timedelta(minutes=self.env_vars.get_grace_minutes()),
+            'doc_title': document.title,
+            'did': document.did,
+            'user_id': document.user_uid,
+            }
+
     def add_attachment(self, **kwargs):
         with self.get_session() as session:
             token = kwargs.get('token')
             if token:
-                token_obj = session.query(Token).filter(Token.token == token).first()
+                token_obj = session.execute(_TOKEN_STMT, {'token': token}).scalar_one_or_none()
                 if token_obj:
-                    did = token_obj.document.did
+                    did = token_obj.did
                     if not self._allow_attachment_upload(did=did):
                         return None
                     attachment = Attachment(did=did, name=kwargs.get('name'), checksum=kwargs.get('checksum'))
@@ -579,14 +741,25 @@ class DatabaseManager:
             
     def delete_orphan_attachments(self):
         with self.get_session() as session:
-            attachments = session.query(Attachment).all()
-            for attachment in attachments:
-                file_path = os.path.join(self.attachmentdir, attachment.aid)
-                if not os.path.exists(file_path):
-                    session.delete(attachment)
-                    print(f"Deleted orphan attachment with aid: {attachment.aid}")
+            aids_in_db = {aid for aid, in session.query(Attachment.aid).all()}
+            orphan_aids = list(aids_in_db - self._list_files(self.attachmentdir))
+
+            self._bulk_delete_attachments(session, orphan_aids)
             session.commit()
 
+            for aid in orphan_aids:
+                print(f"Deleted orphan attachment with aid: {aid}")
+
+    def _list_files(self, directory):
+        """
+        List the names of all files in a directory with a single directory scan.
+
+        :param directory: The directory to scan.
+        :return: A set of file names.
+        """
+        with os.scandir(directory) as entries:
+            return {entry.name for entry in entries if entry.is_file()}
+
     def _delete_attachment_aid(self, aid):
         with self.get_session() as session:
             file_path = os.path.join(self.attachmentdir, aid)
@@ -594,21 +767,23 @@ class DatabaseManager:
                 os.remove(file_path)
                 print(f"Deleted file: {file_path}")
                     
-            attachment = session.query(Attachment).filter(Attachment.aid == aid).first()
-            if attachment:
-                session.delete(attachment)
+            deleted = session.execute(
+                delete(Attachment).where(Attachment.aid == aid).execution_options(synchronize_session=False)
+            ).rowcount
+            if deleted:
                 session.commit()
                 print(f"Deleted attachment with aid: {aid}")
 
     def _allow_attachment_upload(self, did, n = 20):
         with self.get_session() as session:
-            count = session.query(func.count(Attachment.aid)).filter(Attachment.did == did).scalar()
-            return count <= n
+            # Stop scanning as soon as more than n attachments are found
+            attachments = session.query(Attachment.aid).filter(Attachment.did == did).limit(n + 1).all()
+            return len(attachments) <= n
         
     def _check_if_redirect_is_valid(self, redirect):
         try:
             if redirect:
-                if redirect.valid_until >= datetime.now(local_timezone).replace(tzinfo=None):
+                if redirect.valid_until >= _local_now_naive():
                     return True
                 else:
                     return False
@@ -628,7 +803,7 @@ class DatabaseManager:
         user_info = self.get_document_from_token(token)
         if not user_info:
             return None
-        session = self.session
+        session = self._Session()
         try:
             redirect = session.query(Redirect).filter(Redirect.did == user_info.get('did')).first()
                            
@@ -646,13 +821,13 @@ class DatabaseManager:
         finally:
             session.close()
             
-    def _ensure_datetime(self, time_object):
-        if not isinstance(time_object, datetime):
-            try:
-                time_object = datetime.fromisoformat(time_object)
-            except (ValueError, TypeError):
-                raise ValueError("new_expiry_date should be a datetime object or a string in ISO format.")  
-        return time_object
+    def _ensure_datetime(self, time_object, name='new_expiry_date'):
+        if isinstance(time_object, datetime):
+            return time_object
+        try:
+            return datetime.fromisoformat(time_object)
+        except (ValueError, TypeError):
+            raise ValueError(f"{name} should be a datetime object or a string in ISO format.")
 
 
     def add_redirects(self, redirect_list):
@@ -661,13 +836,13 @@ class DatabaseManager:
 
         :param redirect_list: List of dictionaries representing redirects.
         """
-        session = self.session
+        session = self._Session()
         try:
+            # Validate all redirects first and merge repeated entries, later entries win
+            redirects = {}
             for redirect_data in redirect_list:
                 uid = redirect_data.get('uid')
                 did = redirect_data.get('did')
-                url = redirect_data.get('url')
-                description = redirect_data.get('description')
                 valid_until = redirect_data.get('valid_until')
                 if valid_until:
                     valid_until = self._ensure_datetime(valid_until)                    
@@ -675,24 +850,30 @@ class DatabaseManager:
                 if (uid is None and did is None) or (uid is not None and did is not None):
                     raise ValueError("Exactly one of 'uid' and 'did' must be defined.")
 
-                if uid is None and did is None:
-                    continue
-
-                if uid is None:
-                    redirect = session.query(Redirect).filter(Redirect.did == did).first()
-                elif did is None:
-                    redirect = session.query(Redirect).filter(Redirect.uid == uid).first()
-                else:
-                    continue
-
-                if redirect:
-                    redirect.url = url
-                    redirect.description = description
-                    if valid_until:
-                        redirect.valid_until = valid_until
-                else:
-                    new_redirect = Redirect(uid=uid, did=did, url=url, valid_until=valid_until, description = description)
-                    session.add(new_redirect)
+                key = ('did', did) if did is not None else ('uid', uid)
+                redirect = redirects.setdefault(key, {'uid': uid, 'did': did})
+                redirect['url'] = redirect_data.get('url')
+                redirect['description'] = redirect_data.get('description')
+                if valid_until:
+                    redirect['valid_until'] = valid_until
+
+            # Upsert redirects keyed by did and by uid, keeping the stored valid_until if none is given
+            for key_column in ('did', 'uid'):
+                for with_valid_until in (True, False):
+                    rows = [
+                        redirect for (column, _), redirect in redirects.items()
+                        if column == key_column and ('valid_until' in redirect) == with_valid_until
+                    ]
+                    if not rows:
+                        continue
+
+                    update_columns = ['url', 'description', 'valid_until'] if with_valid_until else ['url', 'description']
+                    stmt = sqlite_insert(Redirect)
+                    stmt = stmt.on_conflict_do_update(
+                        index_elements=[key_column],
+                        set_={column: stmt.excluded[column] for column in update_columns},
+                    )
+                    session.execute(stmt, rows)
 
             session.commit()
                 
@@ -712,26 +893,25 @@ class DatabaseManager:
         :param token_list: List of token strings to be checked.
         :return: A dictionary where keys are tokens, and values are boolean indicating validity.
         """
-        session = self.session
+        session = self._Session()
         try:
-            token_validity_dict = {}
-
-            for token_str in token_list:
-                token = session.query(Token).filter(Token.token == token_str).first()
+            tokens = [
+                token for chunk in _chunks(list(token_list))
+                for token in session.query(Token)
+                .options(joinedload(Token.document).joinedload(Document.user))
+                .filter(Token.token.in_(chunk))
+                .all()
+            ]
 
-                if token:
-                    document = self.get_document_from_token(token_str)
-                    if document:
-                        current_time = datetime.utcnow()
-                        isvalid = document['valid_until'] >= current_time
-                        token_validity_dict[token_str] = isvalid
-                    else:
-                        token_validity_dict[token_str] = False
-                else:
-                    # Token not found in the database
-                    token_validity_dict[token_str] = False
+            current_time = datetime.utcnow()
+            valid_tokens = {}
+            for token in tokens:
+                document = token.document
+                if document and document.user:
+                    valid_tokens[token.token] = self._nearest_valid_until(token, document, document.user) >= current_time
 
-            return token_validity_dict
+            # Tokens not found in the database are invalid
+            return {token_str: valid_tokens.get(token_str, False) for token_str in token_list}
 
         except Exception as e:
             print(f"Error checking token validity: {e}")
@@ -744,23 +924,22 @@ class DatabaseManager:
 
         :param rename_dict: A dictionary where keys are the old user names (A) and values are the new user names (B).
         """
-        for old_name, new_name in rename_dict.items():
-            # Query for users with the old name
-            users_to_rename = self.session.query(User).filter(User.uid == old_name).all()
-
-            for user in users_to_rename:
+        with self._Session() as session, session.no_autoflush:
+            for old_name, new_name in rename_dict.items():
                 # Update the user's UID to the new name
-                user.uid = new_name
-    
-                # Query for documents associated with the user
-                documents_to_rename = self.session.query(Document).filter(Document.user_uid == old_name).all()
-    
-                for document in documents_to_rename:
-                    # Update the document's user UID to the new name
-                    document.user_uid = new_name
+                renamed = session.execute(
+                    update(User).where(User.uid == old_name).values(uid=new_name).execution_options(synchronize_session=False)
+                ).rowcount
+
+                if renamed:
+                    # Update the user UID of all documents associated with the user
+                    session.execute(
+                        update(Document).where(Document.user_uid == old_name).values(user_uid=new_name).execution_options(synchronize_session=False)
+                    )
 
-        # Commit the changes to the database
-        self.session.commit()
+            # Commit the changes to the database
+            session.commit()
+            self._document_cache.clear()
 
     def add_user(self, uid):
         """
@@ -768,7 +947,7 @@ class DatabaseManager:
 
         :param uid: The unique identifier for the user.
         """
-        session = self.session
+        session = self._Session()
         try:
             user = session.query(User).filter_by(uid=uid).first()
             if user is None:
@@ -786,22 +965,97 @@ class DatabaseManager:
         Check the existence of files associated with each document in the database.
         If a file does not exist, delete the document from the database.
         """
-        session = self.session
+        session = self._Session()
         try:
-            all_documents = session.query(Document).all()
+            dids_in_db = {did for did, in session.query(Document.did).all()}
 
-            for document in all_documents:
-                file_path = os.path.join(self.docdir, document.did)
-
-                if not os.path.exists(file_path):
-                    # File doesn't exist, delete the document from the database
-                    self.delete_document(document.did)
+            # Delete all documents whose file doesn't exist from the database
+            self._bulk_delete_documents(session, list(dids_in_db - self._list_files(self.docdir)))
+            session.commit()
+            self._document_cache.clear()
 
         except Exception as e:
             print(f"Error checking document file existence: {e}")
         finally:
             session.close()
             
+    def _unlink_files(self, paths):
+        """
+        Delete files from disk, ignoring files that are already gone.
+        Larger batches are removed by a thread pool since unlink releases the GIL.
+
+        :param paths: A list of file paths to delete.
+        """
+        def unlink(path):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+        if len(paths) > 1:
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                list(executor.map(unlink, paths))
+        else:
+            for path in paths:
+                unlink(path)
+
+    def _bulk_delete_users(self, session, uids):
+        """
+        Delete users together with their documents, attachments, tokens, and events without loading them.
+        The caller is responsible for committing the session and removing the files.
+
+        :param session: The session to execute the deletes in.
+        :param uids: A list of user IDs to delete.
+        :return: A tuple of the deleted document IDs and attachment IDs.
+        """
+        dids = []
+        aids = []
+        for chunk in _chunks(uids):
+            dids += [did for did, in session.query(Document.did).filter(Document.user_uid.in_(chunk)).all()]
+            aids += [
+                aid for aid, in session.query(Attachment.aid)
+                .filter(Attachment.did.in_(select(Document.did).where(Document.user_uid.in_(chunk))))
+                .all()
+            ]
+
+        self._bulk_delete_attachments(session, aids)
+        self._bulk_delete_documents(session, dids)
+
+        for chunk in _chunks(uids):
+            session.execute(delete(User).where(User.uid.in_(chunk)).execution_options(synchronize_session=False))
+
+        return dids, aids
+
+    def _bulk_delete_attachments(self, session, aids):
+        """
+        Delete attachments without loading them.
+        The caller is responsible for committing the session and removing the files.
+
+        :param session: The session to execute the deletes in.
+        :param aids: A list of attachment IDs to delete.
+        """
+        for chunk in _chunks(aids):
+            session.execute(delete(Attachment).where(Attachment.aid.in_(chunk)).execution_options(synchronize_session=False))
+
+    def _bulk_delete_documents(self, session, dids):
+        """
+        Delete documents together with their tokens and events without loading them.
+        The caller is responsible for committing the session and removing the files.
+
+        :param session: The session to execute the deletes in.
+        :param dids: A list of document IDs to delete.
+        :return: The number of deleted documents.
+        """
+        deleted = 0
+        for chunk in _chunks(dids):
+            tids = select(Token.tid).where(Token.did.in_(chunk))
+
+            session.execute(delete(Event).where(Event.tid.in_(tids)).execution_options(synchronize_session=False))
+            session.execute(delete(Token).where(Token.did.in_(chunk)).execution_options(synchronize_session=False))
+            deleted += session.execute(delete(Document).where(Document.did.in_(chunk)).execution_options(synchronize_session=False)).rowcount
+
+        return deleted
+
     def add_document(self, data):
         """
         Add a new document to the database.
@@ -809,7 +1063,7 @@ class DatabaseManager:
         :param data: A dictionary containing document data (title, filename, user_uid).
         :return: The unique identifier (did) of the newly added document.
         """
-        session = self.session
+        session = self._Session()
         try:
             data.pop('did', None)
             uid = data.get('user_uid')
@@ -842,11 +1096,12 @@ class DatabaseManager:
         :param did: The unique identifier (did) of the associated document.
         :return: The generated token value for the newly added token.
         """
-        session = self.session
+        session = self._Session()
         try:
             new_token = Token(did=did)
             session.add(new_token)
             session.commit()
+            self._document_cache.clear()
             
             return new_token.token
         except Exception as e:
@@ -857,23 +1112,31 @@ class DatabaseManager:
     def get_document_from_token(self, token_value):
         """
         Retrieve document information associated with a given token.
+        Results are cached for a short time and the cache is cleared whenever tokens, documents or users change.
 
         :param token_value: The value of the token to retrieve document information.
         :return: A dictionary containing document information, or None if not found.
         """
-        with self.get_session() as session:
-            token = session.query(Token).filter_by(token=token_value).first()
+        document_info = self._document_cache.get(token_value, _CACHE_MISS)
+        if document_info is _CACHE_MISS:
+            try:
+                document_info = self._query_document_from_token(token_value)
+            except Exception as e:
+                print(f"An error occurred: {e}")
+                return None
+            self._document_cache.set(token_value, document_info)
+
+        return dict(document_info) if document_info else None
+
+    def _query_document_from_token(self, token_value):
+        with self._Session() as session:
+            token = session.execute(_TOKEN_WITH_DOCUMENT_STMT, {'token': token_value}).scalar_one_or_none()
             if token:
                 document = token.document
                 if document:
                     user = document.user
     
-                    # Find the nearest valid_until among token, document, and user
-                    nearest_valid_until = min(
-                        token.valid_until,
-                        document.valid_until if document.valid_until else datetime.max.replace(tzinfo=local_timezone),
-                        user.valid_until if user.valid_until else datetime.max.replace(tzinfo=local_timezone),
-                    )
+                    nearest_valid_until = self._nearest_valid_until(token, document, user)
     
                     return {
                         'did': document.did,
@@ -892,6 +1155,18 @@ class DatabaseManager:
                 return None
 
 
+    def _nearest_valid_until(self, token, document, user):
+        """
+        Find the nearest valid_until among token, document, and user.
+
+        :return: The earliest valid_until, ignoring unset dates of the document and user.
+        """
+        return min(
+            token.valid_until,
+            document.valid_until if document.valid_until else datetime.max,
+            user.valid_until if user.valid_until else datetime.max,
+        )
+
     def add_event(self, token_value, event=None):
         """
         Add a new event to the database associated with a given token.
@@ -899,12 +1174,28 @@ class DatabaseManager:
         :param token_value: The value of the token for which to add an event.
         :return: None if the token is not found, otherwise, the added event's ID.
         """
-        session = self.session
+        session = self._Session()
         try:
-            token = session.query(Token).filter_by(token=token_value).first()
-            if token:
-                new_event = Event(tid=token.tid, event=event)
-                session.add(new_event)
+            event_date = _now()
+
+            # Insert the event directly from the token lookup
+            inserted = session.execute(
+                insert(Event).from_select(
+                    ['tid', 'date', 'event'],
+                    select(Token.tid, literal(event_date, DateTime), literal(event, String)).where(Token.token == token_value),
+                )
+            )
+            if inserted.rowcount:
+                # Keep the first event of the document up to date
+                session.execute(
+                    update(Document)
+                    .where(
+                        Document.did == select(Token.did).where(Token.token == token_value).scalar_subquery(),
+                        or_(Document.first_event_datetime == None, Document.first_event_datetime > event_date),
+                    )
+                    .values(first_event_datetime=event_date)
+                    .execution_options(synchronize_session=False)
+                )
                 session.commit()
         except Exception as e:
             pass
@@ -918,12 +1209,18 @@ class DatabaseManager:
         :param token_value: The value of the token to count download events.
         :return: The count of download events, or None if the token is not found.
         """
-        session = self.session
+        session = self._Session()
         try:
-            token = session.query(Token).filter_by(token=token_value).first()
-            if token:
-                download_event_count = session.query(Event).filter_by(tid=token.tid, event='download').count()
-                return download_event_count
+            # The outer join keeps the token row, so an unknown token yields no row at all
+            result = (
+                session.query(Token.tid, func.count(Event.eid))
+                .outerjoin(Event, and_(Event.tid == Token.tid, Event.event == 'download'))
+                .filter(Token.token == token_value)
+                .group_by(Token.tid)
+                .first()
+            )
+            if result:
+                return result[1]
             else:
                 return None
         except Exception as e:
@@ -938,15 +1235,17 @@ class DatabaseManager:
         :param token_value: The value of the token to retrieve the first event datetime.
         :return: The datetime of the first event, or None if the token is not found.
         """
-        session = self.session
+        session = self._Session()
         try:
-            token = session.query(Token).filter_by(token=token_value).first()
-            if token:
-                first_event = session.query(Event).filter_by(tid=token.tid).order_by(Event.date).first()
-                if first_event:
-                    return first_event.date
-                else:
-                    return None
+            result = (
+                session.query(Token.tid, func.min(Event.date))
+                .outerjoin(Event, Event.tid == Token.tid)
+                .filter(Token.token == token_value)
+                .group_by(Token.tid)
+                .first()
+            )
+            if result:
+                return result[1]
             else:
                 print(f"Token not found: {token_value}")
                 return None
@@ -962,16 +1261,20 @@ class DatabaseManager:
 
         :param token_value: The value of the token to be deleted.
         """
-        session = self.session
+        session = self._Session()
         try:
-            token = session.query(Token).filter_by(token=token_value).first()
-            if token:
-                # Delete associated events first
-                session.query(Event).filter_by(tid=token.tid).delete()
-                
-                # Delete the token itself
-                session.delete(token)
+            # Remember the document, its first event has to be recomputed without this token
+            did = session.execute(select(Token.did).where(Token.token == token_value)).scalar()
+
+            # Delete associated events first
+            tids = select(Token.tid).where(Token.token == token_value)
+            session.execute(delete(Event).where(Event.tid.in_(tids)).execution_options(synchronize_session=False))
+
+            # Delete the token itself
+            if session.execute(delete(Token).where(Token.token == token_value).execution_options(synchronize_session=False)).rowcount:
+                self._refresh_first_event_datetimes(session, [did])
                 session.commit()
+                self._document_cache.clear()
         except Exception as e:
             print(f"Error deleting token: {e}")
         finally:
@@ -983,24 +1286,15 @@ class DatabaseManager:
 
         :param did: The unique identifier (did) of the document to be deleted.
         """
-        session = self.session
+        session = self._Session()
         try:
-            document = session.query(Document).filter_by(did=did).first()
-            if document:
-                # Delete associated tokens and events first
-                tokens = session.query(Token).filter_by(did=did).all()
-                for token in tokens:
-                    session.query(Event).filter_by(tid=token.tid).delete()
-                    session.delete(token)
-
-                # Delete the document itself
-                session.delete(document)
+            # Delete the document with its tokens and events
+            if self._bulk_delete_documents(session, [did]):
                 session.commit()
+                self._document_cache.clear()
 
                 # Delete the associated file
-                doc_path = os.path.join(self.docdir, did)
-                if os.path.exists(doc_path):
-                    os.remove(doc_path)
+                self._unlink_files([os.path.join(self.docdir, did)])
         except Exception as e:
             print(f"Error deleting document: {e}")
         finally:
@@ -1012,29 +1306,24 @@ class DatabaseManager:
 
         :param uid: The unique identifier (uid) of the user to be deleted.
         """
-        session = sessionmaker(bind=self.engine)()
+        session = self._Session()
         try:
-            user = session.query(User).filter_by(uid=uid).first()
+            user = session.query(User.uid).filter_by(uid=uid).first()
             if user:
-                # Delete associated documents, tokens, and events first
-                documents = session.query(Document).filter_by(user_uid=uid).all()
-                for document in documents:
-                    tokens = session.query(Token).filter_by(did=document.did).all()
-                    for token in tokens:
-                        session.query(Event).filter_by(tid=token.tid).delete()
-                        session.delete(token)
-                    # Delete the associated file
-                    doc_path = os.path.join(self.docdir, document.did)
-                    if os.path.exists(doc_path):
-                        os.remove(doc_path)
-                    # Delete the document itself
-                    session.delete(document)
-
-                # Delete the user itself
-                session.delete(user)
+                # Delete the user with associated documents, attachments, tokens, and events
+                dids, aids = self._bulk_delete_users(session, [uid])
                 session.commit()
-        except Exception as e:
-            print(f"Error deleting user: {e}")
+                self._document_cache.clear()
+
+                # Delete the associated files
+                self._unlink_files(
+                    [os.path.join(self.docdir, did) for did in dids]
+                    + [os.path.join(self.attachmentdir, aid) for aid in aids]
+                )
+        except Exception:
+            session.rollback()
+            logger.exception("delete_user failed uid=%s", uid)
+            raise
         finally:
             session.close()
 
@@ -1049,7 +1338,7 @@ class DatabaseManager:
         new_allow_until = self._ensure_datetime(new_allow_until)
     
         with self.get_session() as session:
-            token = session.query(Token).filter(Token.token == token).first()
+            token = session.execute(_TOKEN_STMT, {'token': token}).scalar_one_or_none()
     
             if token is not None:
                 token.allow_until = new_allow_until
@@ -1065,11 +1354,7 @@ class DatabaseManager:
         new_allow_until = self._ensure_datetime(new_allow_until) 
         
         with self.get_session() as session:
-            tokens = session.query(Token).all()
-
-            for token in tokens:
-                token.allow_until = new_allow_until
-
+            session.query(Token).update({Token.allow_until: new_allow_until}, synchronize_session=False)
             session.commit()
             
     def update_token_attachment_deadline(self, data):
@@ -1081,7 +1366,7 @@ class DatabaseManager:
                 token_value = update_data.get('token')
                 new_allow_until = self._ensure_datetime(update_data.get('expires'))          
     
-                token = session.query(Token).filter_by(token=token).first()
+                token = session.execute(_TOKEN_STMT, {'token': token_value}).scalar_one_or_none()
     
                 if token:
                     token.allow_until = new_allow_until
@@ -1100,6 +1385,7 @@ class DatabaseManager:
                 if document:
                     document.allow_attachment = doc_status.get('allow_attachment', True)
             session.commit()
+            self._document_cache.clear()
 
             
     def update_token_valid_until(self, token_value, new_valid_until):
@@ -1109,18 +1395,15 @@ class DatabaseManager:
         :param token_value: The value of the token to be updated.
         :param new_valid_until: The new 'valid_until' date for the token.
         """
-        if not isinstance(new_valid_until, datetime):
-            try:
-                new_valid_until = datetime.fromisoformat(new_valid_until)
-            except (ValueError, TypeError):
-                raise ValueError("new_valid_until should be a datetime object or a string in ISO format.")
+        new_valid_until = self._ensure_datetime(new_valid_until, 'new_valid_until')
 
-        session = self.session
+        session = self._Session()
         try:
-            token = session.query(Token).filter_by(token=token_value).first()
+            token = session.execute(_TOKEN_STMT, {'token': token_value}).scalar_one_or_none()
             if token:
                 token.valid_until = new_valid_until
                 session.commit()
+                self._document_cache.clear()
             else:
                 print(f"Token not found: {token_value}")
         except Exception as e:
@@ -1135,18 +1418,15 @@ class DatabaseManager:
         :param user_uid: The unique identifier (uid) of the user to be updated.
         :param new_valid_until: The new 'valid_until' date for the user.
         """
-        if not isinstance(new_valid_until, datetime):
-            try:
-                new_valid_until = datetime.fromisoformat(new_valid_until)
-            except (ValueError, TypeError):
-                raise ValueError("new_valid_until should be a datetime object or a string in ISO format.")
+        new_valid_until = self._ensure_datetime(new_valid_until, 'new_valid_until')
     
-        session = self.session
+        session = self._Session()
         try:
             user = session.query(User).filter_by(uid=user_uid).first()
             if user:
                 user.valid_until = new_valid_until
                 session.commit()
+                self._document_cache.clear()
             else:
                 print(f"User not found: {user_uid}")
         except Exception as e:
@@ -1160,20 +1440,17 @@ class DatabaseManager:
     
         :param new_expiry_date: The new 'valid_until' date for all users.
         """
-        if not isinstance(new_expiry_date, datetime):
-            try:
-                new_expiry_date = datetime.fromisoformat(new_expiry_date)
-            except (ValueError, TypeError):
-                raise ValueError("new_expiry_date should be a datetime object or a string in ISO format.")
+        new_expiry_date = self._ensure_datetime(new_expiry_date)
     
-        session = self.session
+        session = self._Session()
         try:
-            users = session.query(User).all()
-            for user in users:
-                user.valid_until = new_expiry_date
+            session.query(User).update({User.valid_until: new_expiry_date}, synchronize_session=False)
             session.commit()
-        except Exception as e:
-            print(f"Error updating expiry date for all users: {e}")
+            self._document_cache.clear()
+        except Exception:
+            session.rollback()
+            logger.exception("set_all_users_expiry_date failed")
+            raise
         finally:
             session.close()
             
@@ -1181,33 +1458,23 @@ class DatabaseManager:
         """
         Delete all expired tokens and associated documents with no remaining tokens.
         """
-        session = self.session
+        session = self._Session()
         try:
-            current_datetime = datetime.now(local_timezone)
+            current_datetime = _now()
 
-            # Delete expired tokens
-            expired_tokens = session.query(Token).filter(Token.valid_until < current_datetime).all()
-            for token in expired_tokens:
-                # Delete associated events first
-                session.query(Event).filter_by(tid=token.tid).delete()
-                session.delete(token)
-
-                # Check if the associated document has no remaining tokens
-                remaining_tokens = session.query(Token).filter_by(did=token.did).count()
-                if remaining_tokens == 0:
-                    # Delete the associated file
-                    doc_path = os.path.join(self.docdir, token.did)
-                    if os.path.exists(doc_path):
-                        os.remove(doc_path)
-
-                    # Delete the document itself
-                    document = session.query(Document).filter_by(did=token.did).first()
-                    if document:
-                        session.delete(document)
+            # Delete expired tokens and the documents without remaining tokens
+            expired_dids = self._delete_expired_tokens(session, current_datetime)
+            self._bulk_delete_documents(session, expired_dids)
 
             session.commit()
-        except Exception as e:
-            print(f"Error deleting expired tokens and documents: {e}")
+            self._document_cache.clear()
+
+            # Delete the associated files
+            self._unlink_files([os.path.join(self.docdir, did) for did in expired_dids])
+        except Exception:
+            session.rollback()
+            logger.exception("delete_expired_tokens_and_documents failed")
+            raise
         finally:
             session.close()
             
@@ -1215,48 +1482,97 @@ class DatabaseManager:
         """
         Delete all expired tokens, documents, and users with no remaining documents.
         """
-        session = self.session
+        session = self._Session()
         try:
-            current_datetime = datetime.now(local_timezone)
+            current_datetime = _now()
     
             # Delete expired tokens
-            expired_tokens = session.query(Token).filter(Token.valid_until < current_datetime).all()
-            for token in expired_tokens:
-                # Delete associated events first
-                session.query(Event).filter_by(tid=token.tid).delete()
-                session.delete(token)
-    
-                # Check if the associated document has no remaining tokens
-                remaining_tokens = session.query(Token).filter_by(did=token.did).count()
-                if remaining_tokens == 0:
-                    # Delete the associated attachments
-                    attachments = session.query(Attachment).filter_by(did=token.did).all()
-                    for attachment in attachments:
-                        file_path = os.path.join(self.attachmentdir, attachment.aid)
-                        if os.path.exists(file_path):
-                            os.remove(file_path)
-                        session.delete(attachment)
-                    
-                    # Delete the associated file
-                    doc_path = os.path.join(self.docdir, token.did)
-                    if os.path.exists(doc_path):
-                        os.remove(doc_path)
-    
-                    # Delete the document itself
-                    document = session.query(Document).filter_by(did=token.did).first()
-                    if document:
-                        session.delete(document)
+            expired_dids = self._delete_expired_tokens(session, current_datetime)
+
+            # Delete the attachments of documents without remaining tokens
+            aids = [
+                aid for chunk in _chunks(expired_dids)
+                for aid, in session.query(Attachment.aid).filter(Attachment.did.in_(chunk)).all()
+            ]
+            self._bulk_delete_attachments(session, aids)
+
+            # Delete the documents without remaining tokens
+            self._bulk_delete_documents(session, expired_dids)
     
             # Delete expired users
-            expired_users = session.query(User).filter(User.valid_until < current_datetime).all()
-            for user in expired_users:
-                self.delete_user(user.uid)
+            expired_uids = [uid for uid, in session.query(User.uid).filter(User.valid_until < current_datetime).all()]
+            user_dids, user_aids = self._bulk_delete_users(session, expired_uids)
     
             session.commit()
-        except Exception as e:
-            print(f"Error deleting expired tokens, documents, and users: {e}")
+            self._document_cache.clear()
+
+            # Delete the files only after the transaction is committed
+            self._unlink_files(
+                [os.path.join(self.docdir, did) for did in expired_dids + user_dids]
+                + [os.path.join(self.attachmentdir, aid) for aid in aids + user_aids]
+            )
+        except Exception:
+            session.rollback()
+            logger.exception("delete_expired_items failed")
+            raise
         finally:
             session.close()
+
+    def _delete_expired_tokens(self, session, current_datetime):
+        """
+        Delete all expired tokens and their events.
+        The caller is responsible for committing the session.
+
+        :param session: The session to execute the deletes in.
+        :param current_datetime: Tokens valid until before this datetime are expired.
+        :return: A list of document IDs that have no remaining tokens.
+        """
+        # Documents whose tokens are all expired have no remaining tokens afterwards
+        expired_dids = [
+            did for did, in session.query(Token.did)
+            .filter(Token.did != None)
+            .group_by(Token.did)
+            .having(func.sum(case((or_(Token.valid_until == None, Token.valid_until >= current_datetime), 1), else_=0)) == 0)
+            .all()
+        ]
+
+        # Documents that keep some of their tokens need their first event recomputed
+        affected_dids = {
+            did for did, in session.query(Token.did)
+            .filter(Token.did != None, Token.valid_until < current_datetime)
+            .distinct()
+        }
+
+        # Delete expired tokens and their events
+        expired_tids = select(Token.tid).where(Token.valid_until < current_datetime)
+        session.execute(delete(Event).where(Event.tid.in_(expired_tids)).execution_options(synchronize_session=False))
+        session.execute(delete(Token).where(Token.valid_until < current_datetime).execution_options(synchronize_session=False))
+
+        self._refresh_first_event_datetimes(session, affected_dids.difference(expired_dids))
+
+        return expired_dids
+
+    def _refresh_first_event_datetimes(self, session, dids):
+        """
+        Recompute first_event_datetime from the remaining events of the given documents.
+        The caller is responsible for committing the session.
+
+        :param session: The session to execute the updates in.
+        :param dids: The document IDs whose tokens or events were deleted.
+        """
+        first_event = (
+            select(func.min(Event.date))
+            .join(Token, Event.tid == Token.tid)
+            .where(Token.did == Document.did)
+            .scalar_subquery()
+        )
+        for chunk in _chunks(list(dids)):
+            session.execute(
+                update(Document)
+                .where(Document.did.in_(chunk))
+                .values(first_event_datetime=first_event)
+                .execution_options(synchronize_session=False)
+            )
             
     def delete_documents_without_events_after_n_days(self, n=30):
         """
@@ -1264,30 +1580,36 @@ class DatabaseManager:
 
         :param n: The number of days after upload_datetime.
         """
-        session = self.session
+        session = self._Session()
         try:
-            current_datetime = datetime.now(local_timezone)
+            current_datetime = _now()
             threshold_datetime = current_datetime - timedelta(days=n)
 
             # Find documents with no events N days after upload_datetime
-            documents_to_delete = (
-                session.query(Document)
-                .outerjoin(Token, Document.did == Token.did)
-                .outerjoin(Event, Token.tid == Event.tid)
-                .group_by(Document.did)
-                .having(and_(
-                    func.max(Event.date) == None,  # No events after create
-                    Document.upload_datetime < threshold_datetime
-                ))
-                .all()
+            has_events = (
+                select(Event.eid)
+                .join(Token, Token.tid == Event.tid)
+                .where(Token.did == Document.did, Event.date != None)
+                .exists()
             )
+            dids = [
+                did for did, in session.query(Document.did)
+                .filter(Document.upload_datetime < threshold_datetime, ~has_events)
+                .all()
+            ]
 
-            # Delete each document using the existing delete_document method
-            for document in documents_to_delete:
-                self.delete_document(document.did)
+            # Delete the documents with their tokens and events in bulk
+            if self._bulk_delete_documents(session, dids):
+                session.commit()
+                self._document_cache.clear()
 
-        except Exception as e:
-            print(f"Error deleting documents without events after {n} days: {e}")
+                # Delete the associated files
+                self._unlink_files([os.path.join(self.docdir, did) for did in dids])
+
+        except Exception:
+            session.rollback()
+            logger.exception("delete_documents_without_events_after_n_days failed n=%s", n)
+            raise
         finally:
             session.close()
 
@@ -1298,21 +1620,23 @@ class DatabaseManager:
         :param token_value: The value of the token to retrieve the associated user.
         :return: A dictionary containing user information, or None if not found.
         """
-        session = self.session
+        session = self._Session()
         try:
-            token = session.query(Token).filter_by(token=token_value).first()
-            if token:
-                user = token.document.user
-                if user:
-                    return {
-                        'uid': user.uid,
-                        'valid_until': user.valid_until,
-                    }
-                else:
-                    print(f"User not found for Token: {token_value}")
-                    return None
+            # Resolve the user of the token with one join instead of loading the token, document and user objects
+            row = (
+                session.query(User.uid, User.valid_until)
+                .join(Document, Document.user_uid == User.uid)
+                .join(Token, Token.did == Document.did)
+                .filter(Token.token == token_value)
+                .first()
+            )
+            if row:
+                return {
+                    'uid': row.uid,
+                    'valid_until': row.valid_until,
+                }
             else:
-                print(f"Token not found: {token_value}")
+                print(f"User not found for Token: {token_value}")
                 return None
         except Exception as e:
             print(f"Error getting user from Token: {token_value} - {e}")
@@ -1328,47 +1652,31 @@ class DatabaseManager:
         :param user_uid: The unique identifier (uid) of the user.
         :return: The average time span as a timedelta object, or None if no relevant data found.
         """
-        session = self.session
+        session = self._Session()
         try:
-            user = session.query(User).filter_by(uid=user_uid).first()
-            if user:
-                documents = user.documents
-                total_time_span = timedelta()
-                
-                total_time_spans = list()
-    
-                for document in documents:
-                    # Check if the document has tokens
-                    if document.tokens:
-                        # Find the earliest event datetime for the document's tokens
-                        earliest_event_datetime = (
-                            session.query(func.min(Event.date))
-                            .join(Token, Event.tid == Token.tid)
-                            .filter(Token.did == document.did)
-                            .scalar()
+            # Count the documents and average over those whose first event happened after the upload in one pass
+            document_count, average_seconds = (
+                session.query(
+                    func.count(Document.did),
+                    func.avg(
+                        case(
+                            (Document.first_event_datetime > Document.upload_datetime, first_event_delay_seconds),
+                            else_=None,
                         )
-    
-                        # Calculate the time span between document upload time and the earliest event
-                        if earliest_event_datetime:
-                            if earliest_event_datetime > document.upload_datetime:
-                                time_span = earliest_event_datetime - document.upload_datetime
-                                total_time_spans.append(time_span)
-    
-                # Calculate the average time span
-                time_sum = timedelta()
-                for zeit in total_time_spans:
-                    time_sum+=zeit
-                    
-                average_time_span = time_sum / len(total_time_spans) if total_time_spans else None
+                    ),
+                )
+                .filter(Document.user_uid == user_uid)
+                .one()
+            )
 
-                return average_time_span
-    
-            else:
-                print(f"User not found: {user_uid}")
+            if not document_count:
+                logger.info("No documents found for user: %s", user_uid)
                 return None
+
+            return seconds_to_timedelta(average_seconds)
     
-        except Exception as e:
-            print(f"Error calculating average time span for user {user_uid}: {e}")
+        except SQLAlchemyError as e:
+            logger.warning("Error calculating average time span for user %s: %s", user_uid, e)
             return None
     
         finally:
@@ -1384,28 +1692,13 @@ class DatabaseManager:
         if average_time_span is None:
             return None
     
-        total_seconds = int(average_time_span.total_seconds())
-        days, remainder = divmod(total_seconds, 86400)  # 86400 seconds in a day
-        hours, remainder = divmod(remainder, 3600)      # 3600 seconds in an hour
-        minutes, seconds = divmod(remainder, 60)        # 60 seconds in a minute
-    
-        if days > 0:
-            if days == 1:
-                return days, 'Tag'
-            else:
-                return days, 'Tage'
-        elif hours > 0:
-            if hours == 1:
-                return hours, 'Stunde'
-            else:
-                return hours, 'Stunden'
-        elif minutes > 0:
-            if minutes == 1:
-                return minutes, 'Minute'
-            else:
-                return minutes, 'Minuten'
-        else:
-            return seconds, 'Sekunden'
+        remainder = int(average_time_span.total_seconds())
+        for unit_seconds, singular, plural in _TIME_SPAN_UNITS:
+            value, remainder = divmod(remainder, unit_seconds)
+            if value > 0:
+                return value, singular if value == 1 else plural
+
+        return remainder, 'Sekunden'
             
     def calculate_average_time_for_token(self, token_value):
         """
@@ -1415,13 +1708,27 @@ class DatabaseManager:
         :param token_value: The value of the token for which to calculate the average time span.
         :return: The average time span as a timedelta object, or None if no relevant data found.
         """
-        user_info = self.get_user_of_token(token_value)
-        if user_info:
-            user_uid = user_info['uid']
-            return self.calculate_average_time_for_user(user_uid)
-        else:
-            print(f"User information not found for Token: {token_value}")
-            return None
+        with self.get_session() as session:
+            # Skip the aggregate if the token does not exist
+            if session.query(Token.tid).filter(Token.token == token_value).first() is None:
+                return None
+
+            # Documents of the user who owns the token's document
+            token_document = aliased(Document)
+
+            average_seconds = (
+                session.query(func.avg(first_event_delay_seconds))
+                .select_from(Document)
+                .join(token_document, token_document.user_uid == Document.user_uid)
+                .join(Token, Token.did == token_document.did)
+                .filter(
+                    Token.token == token_value,
+                    Document.first_event_datetime > Document.upload_datetime,
+                )
+                .scalar()
+            )
+
+            return seconds_to_timedelta(average_seconds)
         
     def calculate_average_time_for_all_users(self):
         """
@@ -1429,101 +1736,92 @@ class DatabaseManager:
     
         :return: A dictionary where keys are user UIDs and values are the average time spans as timedelta objects.
         """
-        session = self.session
+        session = self._Session()
         try:
-            user_average_times = {}
-    
-            # Get all users
-            users = session.query(User).all()
-    
-            for user in users:
-                user_uid = user.uid
-                average_time_span = self.calculate_average_time_for_user(user_uid)
-                user_average_times[user_uid] = average_time_span
-    
-            return user_average_times
+            # Average the time spans of all users in one query, users without documents get None
+            average_seconds = (
+                session.query(User.uid, func.avg(first_event_delay_seconds))
+                .outerjoin(
+                    Document,
+                    and_(
+                        Document.user_uid == User.uid,
+                        Document.first_event_datetime > Document.upload_datetime,
+                    ),
+                )
+                .group_by(User.uid)
+                .all()
+            )
+
+            return {user_uid: seconds_to_timedelta(seconds) for user_uid, seconds in average_seconds}
     
-        except Exception as e:
-            print(f"Error calculating average time span for all users: {e}")
+        except SQLAlchemyError as e:
+            logger.warning("Error calculating average time span for all users: %s", e)
             return None
     
         finally:
             session.close()
             
+    def iter_events(self, chunk=1000):
+        """
+        Iterate over all events with information including date, token, user_uid, and document title.
+        Rows are streamed from the database in chunks instead of being loaded all at once.
+
+        :param chunk: The number of rows fetched from the database per round trip.
+        :return: A generator of dictionaries containing event information.
+        """
+        session = self._Session()
+        try:
+            events = session.execute(_EVENTS_STMT, execution_options={'yield_per': chunk})
+
+            for event in events:
+                yield event._asdict()
+
+        finally:
+            session.close()
+
     def get_events(self):
         """
         Retrieve all events with information including date, token, user_uid, and document title.
     
         :return: A list of dictionaries containing event information.
         """
-        session = self.session
         try:
-            events_info = []
-    
-            # Query all events with related information
-            events = (
-                session.query(Event, Token, Document, User)
-                .join(Token, Event.tid == Token.tid)
-                .join(Document, Token.did == Document.did)
-                .join(User, Document.user_uid == User.uid)
-                .all()
-            )
-    
-            for event, token, document, user in events:
-                event_info = {
-                    'date': event.date,
-                    'event': event.event,
-                    'token': token.token,
-                    'user_uid': user.uid,
-                    'did': document.did,
-                    'title': document.title,
-                }
-                events_info.append(event_info)
+            return list(self.iter_events())
     
-            return events_info
-    
-        except Exception as e:
-            print(f"Error retrieving events: {e}")
+        except SQLAlchemyError as e:
+            logger.warning("Error retrieving events: %s", e)
             return None
-    
+            
+    def iter_documents(self, chunk=1000):
+        """
+        Iterate over all documents with information including document ID (did), title, filename, user UID, and upload datetime.
+        Rows are streamed from the database in chunks instead of being loaded all at once.
+
+        :param chunk: The number of rows fetched from the database per round trip.
+        :return: A generator of dictionaries containing document information.
+        """
+        session = self._Session()
+        try:
+            documents = session.execute(_DOCUMENTS_STMT, execution_options={'yield_per': chunk})
+
+            for document in documents:
+                yield document._asdict()
+
         finally:
             session.close()
-            
+
     def get_documents(self):
         """
         Retrieve all documents with information including document ID (did), title, filename, user UID, and upload datetime.
     
         :return: A list of dictionaries containing document information.
         """
-        session = self.session
         try:
-            documents_info = []
+            return list(self.iter_documents())
     
-            # Query all documents with related information
-            documents = (
-                session.query(Document, User)
-                .join(User, Document.user_uid == User.uid)
-                .all()
-            )
-    
-            for document, user in documents:
-                document_info = {
-                    'did': document.did,
-                    'title': document.title,
-                    'filename': document.filename,
-                    'user_uid': user.uid,
-                    'upload_datetime': document.upload_datetime,
-                }
-                documents_info.append(document_info)
-    
-            return documents_info
-    
-        except Exception as e:
-            print(f"Error retrieving documents: {e}")
+        except SQLAlchemyError as e:
+            logger.warning("Error retrieving documents: %s", e)
             return None
-    
-        finally:
-            session.close()
             
     def get_users(self):
         """
@@ -1531,24 +1829,15 @@ class DatabaseManager:
     
         :return: A list of dictionaries containing user information.
         """
-        session = self.session
+        session = self._Session()
         try:
-            users_info = []
-    
-            # Query all users with related information
-            users = session.query(User).all()
-    
-            for user in users:
-                user_info = {
-                    'uid': user.uid,
-                    'valid_until': user.valid_until,
-                }
-                users_info.append(user_info)
-    
-            return users_info
+            # Query only the user columns instead of full user objects
+            users = session.execute(_USERS_STMT).all()
+
+            return [{'uid': uid, 'valid_until': valid_until} for uid, valid_until in users]
     
-        except Exception as e:
-            print(f"Error retrieving users: {e}")
+        except SQLAlchemyError as e:
+            logger.warning("Error retrieving users: %s", e)
             return None
     
         finally:
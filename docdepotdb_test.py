@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+TEST
+"""
+import os
+from datetime import timedelta
+
+import pytest
+from cryptography.fernet import Fernet
+
+os.environ.setdefault('DOCDEPOT_FERNET_KEY', Fernet.generate_key().decode())
+
+from docdepotdb import *
+
+
+@pytest.fixture
+def db(tmp_path):
+    docdir = tmp_path / 'documents'
+    attachmentdir = tmp_path / 'attachments'
+    docdir.mkdir()
+    attachmentdir.mkdir()
+    return DatabaseManager(data=str(tmp_path / 'data.db'), docdir=str(docdir), attachmentdir=str(attachmentdir))
+
+
+def add_document_with_event(db, title, minutes_after_upload):
+    did = db.add_document({'title': title, 'filename': 'f.pdf', 'user_uid': 'alice', 'checksum': None})
+    token = db.add_token(did)
+    db.add_event(token, event='download')
+
+    # Place the event a fixed time after the upload
+    with db.get_session() as session:
+        document = session.get(Document, did)
+        event_date = document.upload_datetime + timedelta(minutes=minutes_after_upload)
+        tids = select(Token.tid).where(Token.token == token)
+        session.query(Event).filter(Event.tid.in_(tids)).update({Event.date: event_date}, synchronize_session=False)
+        session.query(Document).filter(Document.did == did).update({Document.first_event_datetime: event_date}, synchronize_session=False)
+        session.commit()
+
+    return did, token
+
+
+def average_minutes(db):
+    return round(db.calculate_average_time_for_all_users()['alice'].total_seconds() / 60)
+
+
+def first_event_datetime(db, did):
+    with db.get_session() as session:
+        return session.get(Document, did).first_event_datetime
+
+
+def test_delete_token_resets_first_event_datetime(db):
+    did_a, token_a = add_document_with_event(db, 'A', 10)
+    did_b, token_b = add_document_with_event(db, 'B', 30)
+    assert average_minutes(db) == 20
+
+    db.delete_token(token_b)
+
+    assert first_event_datetime(db, did_b) is None
+    assert first_event_datetime(db, did_a) is not None
+    assert average_minutes(db) == 10
+
+
+def test_delete_token_recomputes_first_event_from_remaining_tokens(db):
+    did, token = add_document_with_event(db, 'A', 10)
+    later_token = db.add_token(did)
+    db.add_event(later_token, event='download')
+
+    db.delete_token(token)
+
+    with db.get_session() as session:
+        remaining = session.query(func.min(Event.date)).scalar()
+    assert first_event_datetime(db, did) == remaining
+
+
+def test_expired_tokens_reset_first_event_datetime(db):
+    did, token = add_document_with_event(db, 'A', 10)
+    valid_token = db.add_token(did)
+    db.update_token_valid_until(token, (datetime.now() - timedelta(days=1)).isoformat())
+
+    db.delete_expired_tokens_and_documents()
+
+    assert db.get_document_from_token(valid_token) is not None
+    assert first_event_datetime(db, did) is None
@@ -5,19 +5,57 @@ helper modules
 """
 import os
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import hashlib
-from PIL import Image
+import base64
+import ssl
 from classify import *
 import json
-
-from cryptography.fernet import Fernet
+import time
+import threading
+import logging
+import mmap
+from functools import cached_property, lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from types import MappingProxyType
+
+from cryptography.fernet import Fernet, InvalidToken
 from datetime import datetime, timedelta
-import urllib
 
 import PyPDF2
-from reportlab.pdfgen import canvas
 import io
 
+logger = logging.getLogger(__name__)
+
+@lru_cache(maxsize=1)
+def _reportlab():
+    """
+    Import reportlab on first use, it is only needed to assemble compressed PDFs.
+
+    :return: A tuple of the canvas module and an ImageReader class that leaves JPEGs undecoded.
+    """
+    from reportlab.pdfgen import canvas
+    from reportlab.lib.utils import ImageReader
+    from reportlab import rl_config
+
+    # JPEG-Daten binär statt ASCII85-kodiert einbetten (spart ca. 25 % Größe)
+    rl_config.useA85 = 0
+
+    class JPEGImageReader(ImageReader):
+        # Canvas.drawImage bildet den Namen des XObjects aus getRGBData(), was das JPEG
+        # vollständig dekodieren würde. Bei JPEGs genügen dafür die Rohbytes, die
+        # anschließend ohnehin unverändert als DCTDecode-Stream eingebettet werden.
+        def getRGBData(self):
+            fp = self.jpeg_fh()
+            if fp is None:
+                return ImageReader.getRGBData(self)
+            self._dataA = None
+            return fp.getvalue()
+
+    return canvas, JPEGImageReader
+
 def json_serialize(data):
     """
     Recursively convert a data structure to a JSON-compatible format.
@@ -34,251 +72,346 @@ def json_serialize(data):
     else:
         return data  # Return the data as is if it's already JSON-compatible
 
+def _pooled_session(pool_maxsize = 16):
+    """
+    Create a requests session that keeps connections to the same host open between requests.
+    Failed connection attempts are retried twice, POST bodies are never resent after a read error.
+
+    :param pool_maxsize: The maximum number of pooled connections per host.
+    :return: The requests session.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections = 16, pool_maxsize = pool_maxsize, max_retries = Retry(total = 2, backoff_factor = 0.1))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+@lru_cache(maxsize=None)
+def _shared_session(pool_maxsize = 16):
+    """
+    Return a process-wide pooled requests session, so connections survive across short-lived API objects.
+
+    :param pool_maxsize: The maximum number of pooled connections per host.
+    :return: The shared requests session.
+    """
+    return _pooled_session(pool_maxsize = pool_maxsize)
+
 class CheckHistory:
     def __init__(self):
-        self.performed_checks = []
+        # Die Prüfungen werden spaltenweise in parallelen Listen gespeichert
+        self._short = []
+        self._passed = []
+        self._description = []
 
     def add_check(self, short, passed = None, description = None):
-        self.performed_checks.append({"passed": passed, "description": description, "short": short})
+        self._short.append(short)
+        self._passed.append(passed)
+        self._description.append(description)
 
     def get_checks(self):
-        return self.performed_checks
+        return [
+            {"passed": passed, "description": description, "short": short}
+            for short, passed, description in zip(self._short, self._passed, self._description)
+        ]
     
     def _get_checks_string(self):
-        checks_string = ""
-        for check in self.performed_checks:
-            checks_string += f"{check['short']}: {'Passed' if check['passed'] else 'Failed'} - {check['description']}\n"
-        return checks_string
+        return "".join(
+            f"{short}: {'Passed' if passed else 'Failed'} - {description}\n"
+            for short, passed, description in zip(self._short, self._passed, self._description)
+        )
 
     def _get_failed_checks_string(self):
-        failed_checks_string = ""
-        for check in self.performed_checks:
-            if check["passed"] == False:
-                failed_checks_string += f"{check['short']}: Failed\n"
-        return failed_checks_string
+        return "".join(
+            f"{short}: Failed\n"
+            for short, passed in zip(self._short, self._passed)
+            if passed == False
+        )
 
     def update_last(self, passed=None, description=None, short=None):
-        if self.performed_checks:
-            last_check = self.performed_checks[-1]
+        if self._short:
             if passed is not None:
-                last_check["passed"] = passed
+                self._passed[-1] = passed
             if description is not None:
-                last_check["description"] = description
+                self._description[-1] = description
             if short is not None:
-                last_check["short"] = short
+                self._short[-1] = short
 
     def _is_passed(self):
-        for check in self.performed_checks:
-            if check["passed"] == False:
-                return False
-        return True
+        return not any(passed == False for passed in self._passed)
 
 class ImageAPI:
-    def __init__(self, url='http://localhost:9000', loaded = None):
+    _raw_headers = {'Content-Type': 'application/octet-stream'}
+
+    def __init__(self, url='http://localhost:9000', loaded = None, max_workers = 8, min_pdf_size = 512 * 1024):
         if not loaded:
             raise ValueError("Must be initialized with FileLoader object")
             
         self.base_url = url
         self.loaded = loaded
+        self.max_workers = max(1, int(max_workers))
+        self.min_pdf_size = max(0, int(min_pdf_size))
+        # ImageAPI wird pro Upload neu erzeugt, die Verbindungen zu imaginary werden prozessweit geteilt
+        self.session = _shared_session(pool_maxsize = max(50, self.max_workers))
         self.format = 'jpeg'
         self.size = 1500
         self.filename = os.path.splitext(os.path.basename(self.loaded.attributes.get('filename')))[0] or 'filename'
         
         self.fullfilename = f'{self.filename}.{self.format}'
 
+        # JSON-Vorlagen der Pipeline-Operationen, pro Aufruf werden nur noch Qualität und Höhe eingesetzt
+        resize = '{"operation": "resize", "params": {"type": "%s", "quality": %%s, "background": "255,255,255", "stripmeta": "true", "height": %%s, "force": "true"}}' % self.format
+        self._resize_tpl = '[' + resize + ']'
+        self._autorotate_resize_tpl = '[{"operation": "autorotate", "params": {"type": "%s"}}, ' % self.format + resize + ']'
+        self._convert_jpeg_ops = json.dumps([
+            {
+                "operation": "convert",
+                "params": {
+                    "type": self.format,
+                    "quality": 100,
+                    "background": "255,255,255",
+                    "stripmeta": "true",
+                    "force": "true",
+                }
+            }
+        ])
+
     def _get_scaled_height(self, width, height):
-        size = self.size
-        # Bestimme das Verhältnis der aktuellen Dimensionen
-        aspect_ratio = width / height
-        
-        if width > height:
-            # Skaliere die Breite auf self.config['size']
-            new_width = size
-            new_height = size / aspect_ratio
-        else:
-            # Skaliere die Höhe auf self.config['size']
-            new_height = size
-            new_width = size * aspect_ratio
-        
-        # Gib die skalierten Dimensionen zurück
-        return int(new_height)
+        # Die längere Seite wird auf self.size skaliert, die Höhe ergibt sich aus dem Seitenverhältnis
+        return int(self.size * height / max(width, height))
     
-    def _generate_pdf_from_list(self, pages):
-        pdf_writer = PyPDF2.PdfWriter()
+    def _generate_pdf_from_list(self, pages, output=None):
+        canvas, ImageReader = _reportlab()
+
+        # Alle Seiten werden nacheinander in dasselbe PDF-Canvas geschrieben,
+        # wahlweise direkt in ein übergebenes Dateiobjekt
+        buffer = io.BytesIO() if output is None else output
+        pdf_canvas = canvas.Canvas(buffer)
+        page_count = 0
 
         for image_data in pages:
             if image_data==None:
                 continue
 
-            # Öffne das JPEG-Bild mit PIL
-            image = Image.open(io.BytesIO(image_data))
-            
-            # Erstelle ein BytesIO-Objekt für das PDF
-            buffer = io.BytesIO()
-
-            # Erstelle ein PDF-Canvas
-            pdf_canvas = canvas.Canvas(buffer)
+            # Lies das JPEG-Bild ohne es zu dekodieren, die Bytes werden unverändert ins PDF übernommen
+            image = ImageReader(io.BytesIO(image_data))
+            width, height = image.getSize()
 
             # Berechne die Größe der PDF-Seite basierend auf der Bildgröße
-            pdf_canvas.setPageSize((image.width, image.height))
+            pdf_canvas.setPageSize((width, height))
+
+            # Füge das Bild in das PDF ein und schließe die Seite ab
+            pdf_canvas.drawImage(image, 0, 0, width=width, height=height)
+            pdf_canvas.showPage()
+            page_count += 1
+
+        if page_count == 0:
+            return None
+
+        # Speichere das PDF-Canvas
+        pdf_canvas.save()
+        return buffer.getvalue() if output is None else output
+
+    def _iter_pages(self, pdf_reader):
+        pages = pdf_reader.pages
+
+        # Durchlaufe jede Seite der PDF-Datei
+        for page in pages:
+            # Bestimme die skalierte Höhe
+            size = self._get_scaled_height(page.mediabox.width, page.mediabox.height)
+
+            # Einseitige PDFs können unverändert an imaginary übergeben werden
+            if len(pages) == 1:
+                yield self.loaded.buffer, size
+                return
 
-            # Füge das Bild in das PDF ein
-            pdf_canvas.drawInlineImage(image, 0, 0)
+            # Erstelle ein io-Stream-Objekt für jede Seite
+            output_stream = io.BytesIO()
 
-            # Speichere das PDF-Canvas
-            pdf_canvas.save()
+            # Erstelle ein PDF-Writer-Objekt und füge die Seite hinzu
+            pdf_writer = PyPDF2.PdfWriter()
+            pdf_writer.add_page(page)
 
-            # Setze das Buffer-Objekt auf den Anfang zurück
-            buffer.seek(0)
+            # Schreibe den Inhalt des PDF-Writer-Objekts in den io-Stream
+            pdf_writer.write(output_stream)
 
-            # Füge die aktuelle Seite dem PDF-Schreiber hinzu
-            pdf_writer.add_page(PyPDF2.PdfReader(buffer).pages[0])
-        return pdf_writer
+            yield output_stream.getvalue(), size
+
+    def compress_pdf(self, output=None):
+        """
+        Compress every page of the loaded PDF via imaginary and reassemble them.
+
+        :param output: Optional writable file object that receives the PDF instead of returning bytes.
+        :return: The PDF bytes (or output), or None on failure.
+        """
+        if not self.loaded.buffer:
+            return None
+
+        # Kleine PDFs werden ohne Umweg über imaginary unverändert übernommen
+        if len(self.loaded.buffer) < self.min_pdf_size:
+            if output is None:
+                return self.loaded.buffer
+            output.write(self.loaded.buffer)
+            return output
 
-    def compress_pdf(self):
         try:
             # Erstelle ein PDF-Reader-Objekt
             pdf_reader = PyPDF2.PdfReader(io.BytesIO(self.loaded.buffer))
-    
-            # Liste für die Speicherung der einzelnen io-Stream-Objekte
-            output_streams = []
-    
-            # Durchlaufe jede Seite der PDF-Datei
-            for page_num in range(len(pdf_reader.pages)):
-                # Erstelle ein io-Stream-Objekt für jede Seite
-                output_stream = io.BytesIO()
-    
-                # Erstelle ein PDF-Writer-Objekt
-                pdf_writer = PyPDF2.PdfWriter()
-    
-                # Extrahiere die Seite
-                page = pdf_reader.pages[page_num]
-                
-                # Bestimme die skalierte Höhe
-                size = self._get_scaled_height(page.mediabox.width, page.mediabox.height)
-
-                # Füge die Seite zum PDF-Writer hinzu
-                pdf_writer.add_page(page)
-    
-                # Schreibe den Inhalt des PDF-Writer-Objekts in den io-Stream
-                pdf_writer.write(output_stream)
-    
-                # Setze die Position des Streams auf den Anfang
-                output_stream.seek(0)
-    
-                # Füge den io-Stream zur Liste hinzu
-                output_streams.append((output_stream.getvalue(),size))
+            page_count = len(pdf_reader.pages)
  
-            converted_bytes = list()
-            for image_data in output_streams:
-                converted_bytes.append(self._convert(image_data[0], height = image_data[1], pdf=True))
-            
-            pdf_converted = self._generate_pdf_from_list(converted_bytes)
-            
-            buffer = io.BytesIO()
-            pdf_converted.write(buffer)
-            buffer.seek(0)
+            # Konvertiere die Seiten parallel, ex.map erhält die Reihenfolge der Seiten.
+            # Die Seiten werden erst beim Einreichen serialisiert, sodass das Aufteilen
+            # der nächsten Seite mit der Konvertierung der vorherigen überlappt.
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, max(1, page_count))) as ex:
+                converted_bytes = list(ex.map(lambda image_data: self._convert(image_data[0], height = image_data[1], pdf=True), self._iter_pages(pdf_reader)))
             
-            return buffer.getvalue()
+            return self._generate_pdf_from_list(converted_bytes, output=output)
     
-        except:
+        except Exception:
+            # Hochgeladene PDFs sind nicht vertrauenswürdig, jeder Fehler gilt als fehlgeschlagene Kompression
+            logger.exception('Fehler beim Komprimieren des PDFs')
             return None
 
-    @none_on_exception
     def _convert(self, image_bytes, height = 1000, quality = 80, pdf=False):
-        operations = [
-            {
-                "operation": "resize",
-                "params": {
-                    "type": self.format,
-                    "quality": quality,
-                    "background": "255,255,255",
-                    "stripmeta": "true",
-                    "height": height,
-                    "force": "true",
-                }
-            }
-        ]
-        if pdf==False:
-            operations = [
-                            {
-                                "operation": "autorotate",
-                                "params": {
-                                    "type": self.format,
-                                }
-                            }
-                         ] + operations
+        template = self._resize_tpl if pdf else self._autorotate_resize_tpl
+        operations = template % (quality, height)
 
         return self._convert_from_operations(image_bytes, operations=operations)
 
-    @none_on_exception
-    def _convert_from_operations(self, image_bytes, operations=[]):
+    def _convert_from_operations(self, image_bytes, operations=None):
         url = f'{self.base_url}/pipeline'
 
-        files = {'file': (self.fullfilename, image_bytes)}
+        # Bereits serialisierte Operationen werden unverändert übernommen
+        if not isinstance(operations, str):
+            operations = json.dumps(operations or [])
+
         params = {
-            'operations': json.dumps(operations)
+            'operations': operations
         }
 
-        response = requests.post(url, params=params, files=files)
+        try:
+            # imaginary liest Anfragen ohne multipart-Content-Type direkt als Bild,
+            # die Bytes werden so ohne Umkopieren in einen multipart-Body gesendet
+            response = self.session.post(url, params=params, data=image_bytes, headers=self._raw_headers)
+        except requests.RequestException as e:
+            print(f'Fehler bei der Anfrage an imaginary: {e}')
+            return None
+
         if response.status_code == 200:
             return response.content
         else:
             print(response.text)
             return None
         
-    @none_on_exception
     def autorotate_and_resize(self):
-        return self._convert(self.loaded.buffer, height = self.size)
+        try:
+            return self._convert(self.loaded.buffer, height = self.size)
+        except Exception:
+            logger.exception('Fehler beim Komprimieren des Bildes')
+            return None
     
-    @none_on_exception
     def image_to_jpeg(self):
-        operations = [
-            {
-                "operation": "convert",
-                "params": {
-                    "type": self.format,
-                    "quality": 100,
-                    "background": "255,255,255",
-                    "stripmeta": "true",
-                    "force": "true",
-                }
-            }
-        ]
-        return self._convert_from_operations(self.loaded.buffer, operations = operations)
+        try:
+            return self._convert_from_operations(self.loaded.buffer, operations = self._convert_jpeg_ops)
+        except Exception:
+            logger.exception('Fehler beim Konvertieren des Bildes')
+            return None
+
+@lru_cache(maxsize=4096)
+def _short_md5(input_string):
+    # Es werden nur die ersten 2 Bytes (4 Hex-Zeichen) des Digests benötigt
+    return hashlib.md5(input_string.encode()).digest()[:2].hex()
 
 class ShortHash:
     def __init__(self, input_string):
         self.input_string = input_string
-        self.short_hash = self.get()
+        self.short_hash = _short_md5(input_string)
 
     def get(self):
-        hash_object = hashlib.md5(self.input_string.encode())
-        return hash_object.hexdigest()[:4]
+        # Der Hash wird bereits im Konstruktor berechnet
+        return self.short_hash
+
+_HASH_CHUNK_SIZE = 1 << 17
+# Ab dieser Größe werden Dateien über mmap gehasht
+_MMAP_THRESHOLD = 32 << 20
+
+# Leerer Ausgangszustand, der pro Prüfsumme kopiert statt neu initialisiert wird
+_SHA256_PRISTINE = hashlib.sha256()
+
+def _check_sha256_backend():
+    """
+    Warn if the linked OpenSSL predates the SHA-NI accelerated code path.
+
+    :return: True if the checksums are computed by OpenSSL 1.1.1 or newer.
+    """
+    if ssl.OPENSSL_VERSION_INFO < (1, 1, 1):
+        logger.warning("%s has no SHA-NI support, checksums will be slower.", ssl.OPENSSL_VERSION)
+        return False
+    return True
+
+@lru_cache(maxsize=1)
+def _hash_pool():
+    # Ein gemeinsamer Thread-Pool für alle parallelen Prüfsummen des Prozesses
+    return ThreadPoolExecutor(max_workers=os.cpu_count(), thread_name_prefix='checksum')
 
 class ChecksumCalculator:
     def __init__(self):
-        self.sha256_hash = hashlib.sha256()
+        self.sha256_hash = _SHA256_PRISTINE.copy()
 
     def update_checksum(self, data):
         self.sha256_hash.update(data)
 
     def calc_from_object(self, obj):
-        self.sha256_hash = hashlib.sha256()
-        self.update_checksum(obj.read())
-
-        checksum = self.sha256_hash.hexdigest()
+        checksum = self._hash_stream(_SHA256_PRISTINE.copy(), obj).hexdigest()
         self.reset_file_position(obj)
         
         return checksum
 
     def calc_from_file(self, file_path):
+        return self._hash_file(file_path)
+
+    @staticmethod
+    def hash_many(paths):
+        """
+        Hash several files in parallel, hashlib releases the GIL while hashing.
+
+        :param paths: The paths of the files to hash.
+        :return: A dictionary mapping each path to its checksum.
+        """
+        paths = list(paths)
+        if len(paths) <= 1:
+            return {path: ChecksumCalculator._hash_file(path) for path in paths}
+
+        return dict(zip(paths, _hash_pool().map(ChecksumCalculator._hash_file, paths)))
+
+    @staticmethod
+    def _hash_file(file_path):
         with open(file_path, 'rb') as file:
-            data = file.read()
-            self.update_checksum(data)
+            # Große Dateien direkt aus dem Page-Cache hashen, ohne Kopie in Python-Puffer
+            if os.fstat(file.fileno()).st_size > _MMAP_THRESHOLD:
+                with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    hash_object = _SHA256_PRISTINE.copy()
+                    hash_object.update(mapped)
+                    return hash_object.hexdigest()
 
-        checksum = self.sha256_hash.hexdigest()
-        return checksum
+            if hasattr(hashlib, 'file_digest'):
+                return hashlib.file_digest(file, hashlib.sha256).hexdigest()
+            return ChecksumCalculator._hash_stream(_SHA256_PRISTINE.copy(), file).hexdigest()
+
+    @staticmethod
+    def _hash_stream(hash_object, obj):
+        # Blockweise in einen wiederverwendeten Puffer lesen, statt die ganze Datei in den Speicher zu laden
+        if not hasattr(obj, 'readinto'):
+            hash_object.update(obj.read())
+            return hash_object
+
+        buffer = bytearray(_HASH_CHUNK_SIZE)
+        view = memoryview(buffer)
+        while True:
+            size = obj.readinto(buffer)
+            if not size:
+                break
+            hash_object.update(view[:size])
+        return hash_object
 
     def reset_file_position(self, file_obj):
         file_obj.seek(0)
@@ -294,12 +427,15 @@ class PushNotify:
                             "title": 'DocDepot',
                         }
         self.payload.update(kwargs)
+        self._session = _pooled_session()
+
+        # JSON-Vorlage der Nachricht, beim Senden wird nur noch der Text eingesetzt
+        self._json_head, self._json_tail = json.dumps({**self.payload, 'message': '__MSG__'}).rsplit('"__MSG__"', 1)
         
     def send(self, message):
         url = f"{self.host}/message?token={self.token}"
-        payload = self.payload.copy()
-        payload['message'] = message
-        response = requests.post(url, json=payload)
+        body = self._json_head + json.dumps(message) + self._json_tail
+        response = self._session.post(url, data=body.encode('utf-8'), headers={'Content-Type': 'application/json'})
         return response.status_code == 200
     
 class CryptCheckSum:
@@ -327,14 +463,15 @@ class CryptCheckSum:
             'now' : datetime.now().isoformat(),
         }
 
-        # Konvertiere das Dictionary in einen JSON-String
-        json_data = json.dumps(data)
+        # Konvertiere das Dictionary in einen kompakten JSON-String (ohne Leerzeichen nach Trennzeichen)
+        json_data = json.dumps(data, separators=(',', ':'))
 
         # Verschlüsseln des JSON-Strings
         encrypted_data = self.fernet.encrypt(json_data.encode()).decode('utf-8')
 
         if self.urlsafe:
-            encrypted_data = urllib.parse.quote_plus(encrypted_data)
+            # Fernet liefert urlsafe-Base64, nur das Padding '=' muss maskiert werden
+            encrypted_data = encrypted_data.replace('=', '%3D')
 
         return encrypted_data
 
@@ -342,7 +479,7 @@ class CryptCheckSum:
         try:
             """Entschlüsselt den gegebenen String und gibt ein Dictionary zurück."""
             if self.urlsafe:
-                encrypted_string = urllib.parse.unquote(encrypted_string)
+                encrypted_string = encrypted_string.replace('%3D', '=').replace('%3d', '=')
 
             encrypted_data = encrypted_string.encode('utf-8')
     
@@ -358,19 +495,16 @@ class CryptCheckSum:
                 data['doc_upload_time'] = self._parse_time(data['doc_upload_time'])
     
             return data
-        except:
+        except (InvalidToken, ValueError, TypeError, AttributeError):
             return None
 
     @staticmethod
     def _validate_fernet_key(key):
         """Überprüft, ob der gegebene Fernet-Schlüssel gültig ist."""
+        # Ein Fernet-Key besteht aus 32 Bytes in urlsafe-Base64-Kodierung
         try:
-            fernet = Fernet(key)
-            test_data = b'test'
-            encrypted_data = fernet.encrypt(test_data)
-            fernet.decrypt(encrypted_data)
-            return True
-        except:
+            return len(base64.urlsafe_b64decode(key)) == 32
+        except (TypeError, ValueError):
             return False
 
     @staticmethod
@@ -390,19 +524,74 @@ class CryptCheckSum:
             except ValueError:
                 pass
             
-            formats = [
-                "%Y-%m-%d %H:%M:%S",
-                "%Y-%m-%d",
-                "%d.%m.%Y",
-            ]
-            for fmt in formats:
-                try:
-                    return datetime.strptime(upload_time, fmt)
-                except ValueError:
-                    continue
+            # Anhand der Trennzeichen kommt jeweils nur ein Format in Frage
+            if '.' in upload_time:
+                fmt = "%d.%m.%Y"
+            elif ':' in upload_time:
+                fmt = "%Y-%m-%d %H:%M:%S"
+            else:
+                fmt = "%Y-%m-%d"
+
+            try:
+                return datetime.strptime(upload_time, fmt)
+            except ValueError:
+                pass
         
         raise ValueError("upload_time muss ein datetime-Objekt oder ein gültiger Zeitstring sein.")
 
+class TTLCache:
+    """
+    Small thread-safe cache whose entries expire after a fixed number of seconds.
+    """
+    def __init__(self, maxsize=4096, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+
+            expires, value = entry
+            if expires < time.monotonic():
+                # Abgelaufene Einträge entfernen
+                del self._data[key]
+                return default
+
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+
+            # Älteste Einträge verwerfen, wenn die maximale Größe überschritten ist
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+@lru_cache(maxsize=256)
+def _format_seconds(total_seconds):
+    days = total_seconds // 86400
+    hours = (total_seconds % 86400) // 3600
+    minutes = (total_seconds % 3600) // 60
+
+    parts = []
+    if days > 0:
+        parts.append(f"{days} Tag{'en' if days > 1 else ''}")
+    if hours > 0 or days > 0:
+        parts.append(f"{hours} Stunde{'n' if hours != 1 else ''}")
+    if minutes > 0 or hours > 0 or days > 0:
+        parts.append(f"{minutes} Minute{'n' if minutes != 1 else ''}")
+
+    return ', '.join(parts) if parts else '0 Minuten'
+
 class TimedeltaFormatter:
     def __init__(self, td):
         if not isinstance(td, timedelta):
@@ -410,65 +599,127 @@ class TimedeltaFormatter:
         self.td = td
 
     def format(self):
-        total_seconds = int(self.td.total_seconds())
-        days = total_seconds // 86400
-        hours = (total_seconds % 86400) // 3600
-        minutes = (total_seconds % 3600) // 60
-
-        parts = []
-        if days > 0:
-            parts.append(f"{days} Tag{'en' if days > 1 else ''}")
-        if hours > 0 or days > 0:
-            parts.append(f"{hours} Stunde{'n' if hours != 1 else ''}")
-        if minutes > 0 or hours > 0 or days > 0:
-            parts.append(f"{minutes} Minute{'n' if minutes != 1 else ''}")
-
-        return ', '.join(parts) if parts else '0 Minuten'
+        # Gleiche Zeitspannen wiederholen sich häufig, daher wird das Ergebnis zwischengespeichert
+        return _format_seconds(int(self.td.total_seconds()))
 
 class EnvironmentConfigProvider:
+    _parse_bool = staticmethod(lambda s: str(s).lower() in ('1', 'true', 'yes'))
+
     def __init__(self):
-        self.apikey = os.environ.get("DOCDEPOT_API_KEY", "test")
-        self.default_redirect = os.environ.get("DOCDEPOT_DEFAULT_REDIRECT", None)
-        self.grace_minutes = os.environ.get("DOCDEPOT_GRACE_MINUTES", 0)
-        self.fernet_key = os.environ.get("DOCDEPOT_FERNET_KEY")
-        
+        # Der Fernet-Key wird weiterhin sofort geprüft, alle anderen Werte erst beim ersten Zugriff gelesen
         if CryptCheckSum._validate_fernet_key(self.fernet_key)==False:
             raise ValueError("Invalid Fernet key")
-        
-        
-        self.default_attachment_days = os.environ.get("DOCDEPOT_DAYS_TO_ALLOW_ATTACHMENT", 14)
-        self.enable_redirect = os.environ.get("DOCDEPOT_ENABLE_REDIRECT", "False").lower() == "true"
-        self.show_info = os.environ.get("DOCDEPOT_SHOW_INFO", "False").lower() == "true"
-        self.show_response_time = os.environ.get("DOCDEPOT_SHOW_RESPONSE_TIME", "False").lower() == "true"
-        self.show_timestamp = os.environ.get("DOCDEPOT_SHOW_TIMESTAMP", "False").lower() == "true"
-        self.github_repo = os.environ.get("DOCDEPOT_GITHUB_REPO", "https://github.com/tna76874/docdepot")
-        self.cleanup_db_on_start = os.environ.get("DOCDEPOT_CLEANUP_ON_START", "True").lower() == "true"
-        
-        self.document_policy_url = os.environ.get("DOCDEPOT_DOCUMENT_POLICY_URL", False)
 
-        
-        self.gotify_host = self._read_var('GOTIFY_HOST')
-        self.gotify_token = self._read_var('GOTIFY_TOKEN')
-        self.gotify_priority = int(self._read_var('GOTIFY_PRIORITY') or 8)
-        
-        self.imaginary_host = self._read_var('IMAGINARY_HOST')
-        
-        self.classify_host = self._read_var('CNN_HOST')
-        self.classify_key = self._read_var('CNN_API_KEY')
-        self.classify_model_threshold = float(self._read_var('DOCDEPOT_MODEL_THRESHOLD') or 0.55)
+        _check_sha256_backend()
+
+        # Benachrichtigungs-Clients je Titel, werden beim ersten Aufruf erzeugt
+        self._gotify_clients = {}
 
-        self.blur_threshold = float(self._read_var('DOCDEPOT_BLUR_THRESHOLD') or 40)
+    @cached_property
+    def apikey(self):
+        return os.environ.get("DOCDEPOT_API_KEY", "test")
+
+    @cached_property
+    def default_redirect(self):
+        return os.environ.get("DOCDEPOT_DEFAULT_REDIRECT", None)
+
+    @cached_property
+    def grace_minutes(self):
+        return os.environ.get("DOCDEPOT_GRACE_MINUTES", 0)
+
+    @cached_property
+    def fernet_key(self):
+        return os.environ.get("DOCDEPOT_FERNET_KEY")
+
+    @cached_property
+    def default_attachment_days(self):
+        return os.environ.get("DOCDEPOT_DAYS_TO_ALLOW_ATTACHMENT", 14)
+
+    @cached_property
+    def enable_redirect(self):
+        return self._parse_bool(os.environ.get("DOCDEPOT_ENABLE_REDIRECT", "False"))
+
+    @cached_property
+    def show_info(self):
+        return self._parse_bool(os.environ.get("DOCDEPOT_SHOW_INFO", "False"))
+
+    @cached_property
+    def show_response_time(self):
+        return self._parse_bool(os.environ.get("DOCDEPOT_SHOW_RESPONSE_TIME", "False"))
+
+    @cached_property
+    def show_timestamp(self):
+        return self._parse_bool(os.environ.get("DOCDEPOT_SHOW_TIMESTAMP", "False"))
+
+    @cached_property
+    def github_repo(self):
+        return os.environ.get("DOCDEPOT_GITHUB_REPO", "https://github.com/tna76874/docdepot")
+
+    @cached_property
+    def cleanup_db_on_start(self):
+        return self._parse_bool(os.environ.get("DOCDEPOT_CLEANUP_ON_START", "True"))
+
+    @cached_property
+    def document_policy_url(self):
+        return os.environ.get("DOCDEPOT_DOCUMENT_POLICY_URL", False)
+
+    @cached_property
+    def gotify_host(self):
+        return self._read_var('GOTIFY_HOST')
+
+    @cached_property
+    def gotify_token(self):
+        return self._read_var('GOTIFY_TOKEN')
+
+    @cached_property
+    def gotify_priority(self):
+        return int(self._read_var('GOTIFY_PRIORITY') or 8)
+
+    @cached_property
+    def imaginary_host(self):
+        return self._read_var('IMAGINARY_HOST')
+
+    @cached_property
+    def imaginary_concurrency(self):
+        try:
+            return int(self._read_var('DOCDEPOT_IMAGINARY_CONCURRENCY') or 8)
+        except ValueError:
+            return 8
+
+    @cached_property
+    def imaginary_min_pdf_size(self):
+        # PDFs unter dieser Größe (in KB) werden nicht komprimiert
+        try:
+            return int(self._read_var('DOCDEPOT_PDF_COMPRESS_MIN_KB') or 512) * 1024
+        except ValueError:
+            return 512 * 1024
+
+    @cached_property
+    def classify_host(self):
+        return self._read_var('CNN_HOST')
+
+    @cached_property
+    def classify_key(self):
+        return self._read_var('CNN_API_KEY')
+
+    @cached_property
+    def classify_model_threshold(self):
+        return float(self._read_var('DOCDEPOT_MODEL_THRESHOLD') or 0.55)
+
+    @cached_property
+    def blur_threshold(self):
+        return float(self._read_var('DOCDEPOT_BLUR_THRESHOLD') or 40)
 
     def get_grace_minutes(self):
         try:
             return int(self.grace_minutes)
-        except:
+        except (TypeError, ValueError):
             return 0
     
     def get_default_attachment_days(self):
         try:
             return int(self.default_attachment_days)
-        except:
+        except (TypeError, ValueError):
             return 14
         
     def _read_var(self, var_name):
@@ -480,29 +731,30 @@ class EnvironmentConfigProvider:
     
     def _get_imaginary(self, loaded):
         if self.imaginary_host is not None:
-            return ImageAPI(url = self.imaginary_host, loaded=loaded)
+            return ImageAPI(url = self.imaginary_host, loaded=loaded, max_workers = self.imaginary_concurrency, min_pdf_size = self.imaginary_min_pdf_size)
         return None
     
     def _get_gotify(self, title = 'DocDepot'):
         if self.gotify_host is not None and self.gotify_token is not None:
-            return PushNotify(self.gotify_host, self.gotify_token, title = title, priority = self.gotify_priority)
+            if title not in self._gotify_clients:
+                self._gotify_clients[title] = PushNotify(self.gotify_host, self.gotify_token, title = title, priority = self.gotify_priority)
+            return self._gotify_clients[title]
         return None
     
     def _get_classify(self):
+        return self._classifier
+
+    @cached_property
+    def _classifier(self):
         if (not self.classify_host) or (not self.classify_key):
             return None
         
-        try:
-            classifier = ImageClassifier(url=self.classify_host, api_key = self.classify_key, threshold = self.classify_model_threshold)
-            return classifier
-        except:
-            return None
-        
-        else:
-            return None
+        return ImageClassifier(url=self.classify_host, api_key = self.classify_key, threshold = self.classify_model_threshold)
 
-    def _get_html_configs(self):
-        html_configs = {
+    @cached_property
+    def _html_configs(self):
+        # Unveränderliche Sicht, da alle Aufrufer dieselbe Instanz erhalten
+        return MappingProxyType({
             "default_redirect": self.default_redirect,
             "show_info": self.show_info,
             "show_response_time": self.show_response_time,
@@ -510,8 +762,20 @@ class EnvironmentConfigProvider:
             "github_repo": self.github_repo,
             "enable_redirect" : self.enable_redirect,
             "document_policy_url" : self.document_policy_url,
-        }
-        return html_configs
+        })
+
+    def _get_html_configs(self):
+        return self._html_configs
+
+
+@lru_cache(maxsize=1)
+def get_env_config():
+    """
+    Liefert eine prozessweit geteilte Instanz von EnvironmentConfigProvider.
+
+    :return: EnvironmentConfigProvider
+    """
+    return EnvironmentConfigProvider()
 
 
 